@@ -0,0 +1,56 @@
+# Keyboard button parsing: the old search_i18n_key, which translated every
+# candidate key with python-i18n and compared, against the reverse index of
+# tw_i18n.parse_key. python-i18n is no longer a dependency of the bot; without
+# it only the new path is timed.
+#
+#   pip install 'python-i18n[YAML]'  # for the old path
+#   python bench/bench_i18n.py [iterations]
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from tw_i18n import load_translations, translate, parse_key, use_locale
+
+TYPE_KEYS = ['food', 'thing', 'clothes', 'skill', 'all']
+
+def old_search_i18n_key(locale):
+    # the bot before tw_i18n, with its python-i18n settings
+    import i18n
+    i18n.load_path.append(os.path.join(ROOT, 'translations'))
+    i18n.set('enable_memoization', True)
+    i18n.set('fallback', 'en')
+    i18n.set('locale', locale)
+    def search_i18n_key(text, keys):
+        for k in keys:
+            if i18n.t(f'tw_bot.{k}') == text:
+                return k
+        return None
+    return search_i18n_key
+
+def bench(label, func, texts, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            func(text, TYPE_KEYS)
+    elapsed = time.perf_counter() - start
+    print(f'{label:>16}: {elapsed / (iterations * len(texts)) * 1e6:6.2f} us/lookup')
+
+def main(iterations):
+    load_translations(os.path.join(ROOT, 'translations'))
+    try:
+        search_i18n_key = old_search_i18n_key('de')
+    except ImportError:
+        search_i18n_key = None
+        print('python-i18n is not installed, timing the reverse index only')
+    with use_locale('de'):
+        texts = [translate(k) for k in TYPE_KEYS] + ['kein Knopf']
+        if search_i18n_key is not None:
+            for text in texts:
+                assert search_i18n_key(text, TYPE_KEYS) == parse_key(text, TYPE_KEYS)
+            bench('python-i18n', search_i18n_key, texts, iterations)
+        bench('reverse index', parse_key, texts, iterations)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
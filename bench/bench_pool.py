@@ -0,0 +1,50 @@
+# Compares opening a SpatiaLite connection per query (the old tw_db behaviour)
+# against handing out connections from the pre-initialized pool. Expects a
+# database that was already created by the bot's init_db().
+#
+#   python bench/bench_pool.py [db.sqlite] [queries] [concurrency]
+import os
+import sys
+import time
+import asyncio
+import aiosqlite
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tw_db import ConnectionPool, DB_POOL_SIZE
+
+QUERY = "SELECT count(*) FROM geteilt WHERE expires_at > ? AND user_id <> ?;"
+
+async def per_call(path):
+    async with aiosqlite.connect(path) as db:
+        await db.enable_load_extension(True)
+        await db.load_extension('mod_spatialite')
+        async with db.execute(QUERY, ('20000101', 0)) as cursor:
+            return await cursor.fetchone()
+
+async def pooled(pool):
+    async with pool.acquire() as db:
+        async with db.execute(QUERY, ('20000101', 0)) as cursor:
+            return await cursor.fetchone()
+
+async def run(label, make_call, queries, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    async def one():
+        async with sem:
+            await make_call()
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(queries)])
+    elapsed = time.perf_counter() - start
+    print(f'{label:>10}: {queries} queries in {elapsed:.3f}s ({queries / elapsed:.0f} q/s)')
+
+async def main(path, queries, concurrency):
+    await run('per-call', lambda: per_call(path), queries, concurrency)
+    pool = ConnectionPool(path, DB_POOL_SIZE)
+    await pool.open()
+    await run('pool', lambda: pooled(pool), queries, concurrency)
+    await pool.close()
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'db.sqlite'
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    asyncio.run(main(path, queries, concurrency))
@@ -0,0 +1,62 @@
+# Radius search latency: the R*Tree-pruned search_db_entry query against the
+# previous full scan that evaluated PtDistWithin for every unexpired row.
+#
+#   python bench/bench_spatial.py [entries] [queries]
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import tw_db
+from tw_db import init_db, close_db, connection, fetch_all, search_db_entry, POINT
+
+FULL_SCAN_QUERY = f"""SELECT * FROM geteilt WHERE expires_at > ? AND user_id <> ?
+    AND PtDistWithin(geteilt.latlng, {POINT}, ?) = TRUE;"""
+
+class Location:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+def random_point(rnd):
+    # roughly Germany
+    return rnd.uniform(47.3, 55.0), rnd.uniform(5.9, 15.0)
+
+async def populate(entries, rnd):
+    rows = []
+    for i in range(entries):
+        lat, lng = random_point(rnd)
+        rows.append((i % 5000, 'de', rnd.choice(['food', 'thing', 'clothes', 'skill']), rnd.choice(['offer', 'search']),
+                     lat, lng, 'bench entry', '20220101', '99991231', lng, lat))
+    async with connection() as db:
+        await db.executemany(f"""INSERT INTO geteilt(user_id, user_lang, type, kind, lat, lng, desc, inserted_at, expires_at, latlng)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {POINT});""", rows)
+        await db.commit()
+
+async def main(entries, queries):
+    rnd = random.Random(42)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    tw_db.use_db(path)
+    await init_db()
+    await populate(entries, rnd)
+    print(f'{entries} entries')
+    for km in [5, 10, 50, 100]:
+        points = [Location(*random_point(rnd)) for _ in range(queries)]
+        start = time.perf_counter()
+        for p in points:
+            await fetch_all(FULL_SCAN_QUERY, ('20000101', -1, p.longitude, p.latitude, km * 1000))
+        scan = (time.perf_counter() - start) / queries
+        start = time.perf_counter()
+        for p in points:
+            await search_db_entry(-1, 'all', 'all', p, km)
+        indexed = (time.perf_counter() - start) / queries
+        print(f'{km:>4} km: full scan {scan * 1000:8.2f} ms, spatial index {indexed * 1000:8.2f} ms')
+    await close_db()
+
+if __name__ == '__main__':
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    asyncio.run(main(entries, queries))
@@ -0,0 +1,61 @@
+# Matching new entries against the in-memory SubscriptionIndex compared with a
+# linear scan over every subscription (what the database did before the
+# R*Tree), plus a consistency check of both result sets.
+#
+#   python bench/bench_subscriptions.py [subscriptions] [points]
+import os
+import sys
+import time
+import random
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tw_geo import haversine
+from tw_subscriptions import SubscriptionIndex
+
+TYPES = ['food', 'thing', 'clothes', 'skill', 'all']
+KINDS = ['offer', 'search', 'all']
+
+def random_point(rnd):
+    return rnd.uniform(47.3, 55.0), rnd.uniform(5.9, 15.0)
+
+def make_rows(count, rnd):
+    rows = []
+    for i in range(count):
+        if rnd.random() < 0.02:
+            lat, lng, distance = None, None, None
+        else:
+            (lat, lng), distance = random_point(rnd), rnd.choice([5, 10, 50, 100]) * 1000
+        rows.append((i + 1, rnd.randrange(count // 2), 'de', rnd.choice(TYPES), rnd.choice(KINDS), lat, lng, distance, 'instant'))
+    return rows
+
+def linear_match(rows, user_id, type, kind, lat, lng):
+    return [(r[1], r[2], r[7], r[8]) for r in rows
+            if r[1] != user_id and r[3] in (type, 'all') and r[4] in (kind, 'all')
+            and (r[5] is None or haversine(r[5], r[6], lat, lng) <= r[7])]
+
+def main(count, points):
+    rnd = random.Random(7)
+    rows = make_rows(count, rnd)
+    index = SubscriptionIndex()
+    start = time.perf_counter()
+    index.load(rows)
+    print(f'load {count} subscriptions: {time.perf_counter() - start:.2f}s')
+    queries = [(rnd.randrange(count), rnd.choice(TYPES[:-1]), rnd.choice(KINDS[:-1])) + random_point(rnd) for _ in range(points)]
+
+    start = time.perf_counter()
+    linear = [linear_match(rows, *q) for q in queries]
+    scan = (time.perf_counter() - start) / points
+    start = time.perf_counter()
+    indexed = [index.match(*q) for q in queries]
+    lookup = (time.perf_counter() - start) / points
+    print(f'linear scan {scan * 1000:8.3f} ms/match, index {lookup * 1000:8.3f} ms/match')
+
+    mismatches = sum(Counter(a) != Counter(b) for a, b in zip(linear, indexed))
+    print(f'{mismatches} mismatching results')
+    assert index.diff(rows) == ([], [], [])
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    points = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    main(count, points)
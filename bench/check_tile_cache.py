@@ -0,0 +1,56 @@
+# Checks that the disk tile cache (tw_tiles) evicts the least recently used
+# tiles, not the least recently fetched ones, also after a restart rescanned
+# the directory: a tile fetched long ago but hit all the time has to survive
+# while tiles nobody asked for again are evicted. Tiles come from a stand-in,
+# no network is needed. Exits with 1 if the order is wrong.
+#
+#   python bench/check_tile_cache.py [tiles]
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tw_tiles import CachingTileDownloader
+
+TILE_BYTES = 1000
+
+class Provider:
+    def name(self):
+        return 'check'
+
+    def url(self, zoom, x, y):
+        return f'http://tiles.invalid/{zoom}/{x}/{y}.png'
+
+def downloader(cache_dir, tiles):
+    tiles_downloader = CachingTileDownloader(cache_dir, max_bytes=tiles * TILE_BYTES, memory_tiles=2)
+    tiles_downloader._fetch = lambda url, modified_since: b'\x89' * TILE_BYTES
+    return tiles_downloader
+
+def main(tiles):
+    cache_dir = tempfile.mkdtemp(prefix='tw_tiles_')
+    provider = Provider()
+    first = downloader(cache_dir, tiles)
+    first.get(provider, cache_dir, 1, 0, 0)
+    hot = first.cache_file_name(provider, cache_dir, 1, 0, 0)
+    # fetched a day ago, still within the ttl
+    day_ago = time.time() - 24 * 3600
+    os.utime(hot, (day_ago, day_ago))
+    first._memory.clear()
+    for x in range(1, tiles - 1):
+        first.get(provider, cache_dir, 1, x, 0)
+        first.get(provider, cache_dir, 1, 0, 0)
+    # a restart orders the cache from the directory alone
+    second = downloader(cache_dir, tiles)
+    for x in range(tiles - 1, 3 * tiles):
+        second.get(provider, cache_dir, 1, x, 0)
+        second.get(provider, cache_dir, 1, 0, 0)
+    cold = first.cache_file_name(provider, cache_dir, 1, 1, 0)
+    # evicted and fetched again, the hot tile would have a new mtime
+    kept = os.path.exists(hot) and abs(os.stat(hot).st_mtime - day_ago) < 1
+    evicted = not os.path.exists(cold)
+    print(f'hot tile kept: {kept}, cold tile evicted: {evicted}')
+    return 0 if kept and evicted else 1
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
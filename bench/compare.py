@@ -0,0 +1,46 @@
+# Compares two bench/run.py reports case by case and exits with 1 if any case
+# got slower than the threshold allows.
+#
+#   python bench/compare.py base.json new.json [--metric p50_ms] [--threshold 0.1]
+import sys
+import json
+import argparse
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main(args):
+    base = load(args.base)
+    new = load(args.new)
+    for key in ('entries', 'subscriptions', 'seed'):
+        if base['meta'].get(key) != new['meta'].get(key):
+            print(f'warning: {key} differs ({base["meta"].get(key)} vs {new["meta"].get(key)}), results are not comparable')
+    print(f'{base["meta"].get("commit")} -> {new["meta"].get("commit")}, {args.metric}')
+    regressions = 0
+    for name in sorted(set(base['results']) | set(new['results'])):
+        old = base['results'].get(name, {}).get(args.metric)
+        cur = new['results'].get(name, {}).get(args.metric)
+        if old is None or cur is None:
+            print(f'{name:<36} {"only in " + ("base" if cur is None else "new"):>24}')
+            continue
+        change = (cur - old) / old if old else 0.0
+        flag = ''
+        # below min_ms timer noise dominates
+        if change > args.threshold and cur - old > args.min_ms:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif change < -args.threshold and old - cur > args.min_ms:
+            flag = '  faster'
+        print(f'{name:<36} {old:10.3f} {cur:10.3f} {change:+8.1%}{flag}')
+    print(f'{regressions} regressions')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--metric', default='p50_ms')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative slowdown')
+    parser.add_argument('--min-ms', type=float, default=0.05, help='ignore differences smaller than this')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,138 @@
+# Synthetic data for the benchmarks: entries and subscriptions placed around
+# German cities with a spread that grows with the population, plus a share of
+# rural points, written to a database created by tw_db.init_db().
+#
+#   python bench/generate.py [db.sqlite] [entries] [subscriptions] [seed]
+import os
+import sys
+import math
+import time
+import random
+import asyncio
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import tw_db
+from tw_db import init_db, close_db, import_db_entries, import_db_subscriptions
+
+# name, lat, lng, population in millions
+CITIES = [
+    ('Berlin', 52.520, 13.405, 3.6),
+    ('Hamburg', 53.551, 9.994, 1.8),
+    ('München', 48.137, 11.575, 1.5),
+    ('Köln', 50.938, 6.960, 1.1),
+    ('Frankfurt', 50.110, 8.682, 0.75),
+    ('Stuttgart', 48.776, 9.183, 0.63),
+    ('Düsseldorf', 51.228, 6.773, 0.62),
+    ('Leipzig', 51.340, 12.375, 0.6),
+    ('Dortmund', 51.514, 7.468, 0.59),
+    ('Essen', 51.456, 7.012, 0.58),
+    ('Bremen', 53.079, 8.802, 0.57),
+    ('Dresden', 51.050, 13.738, 0.56),
+    ('Hannover', 52.376, 9.732, 0.54),
+    ('Nürnberg', 49.452, 11.077, 0.52),
+    ('Kiel', 54.323, 10.123, 0.25),
+    ('Freiburg', 47.999, 7.842, 0.23),
+    ('Rostock', 54.092, 12.099, 0.21),
+    ('Regensburg', 49.013, 12.101, 0.15),
+]
+RURAL_SHARE = 0.1
+BOUNDS = (47.3, 55.0, 5.9, 15.0)
+
+TYPES = ['food', 'thing', 'clothes', 'skill']
+TYPE_WEIGHTS = [4, 3, 2, 1]
+KINDS = ['offer', 'search']
+KIND_WEIGHTS = [3, 1]
+LANGS = ['de', 'en']
+LANG_WEIGHTS = [9, 1]
+DISTANCES = [1, 5, 10, 25, 50, 100]
+DISTANCE_WEIGHTS = [2, 4, 3, 2, 1, 1]
+EVERYWHERE_SHARE = 0.03
+DELIVERIES = ['instant', 'hourly', 'daily']
+DELIVERY_WEIGHTS = [6, 1, 3]
+WORDS = ('apfel brot fahrrad jacke lampe regal stuhl tisch buch schuhe kinderwagen '
+         'nachhilfe gitarre kuchen marmelade pflanzen werkzeug sofa mantel spiel').split()
+
+class Location:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+class ClusteredPoints:
+    def __init__(self, rnd):
+        self._rnd = rnd
+        self._weights = [c[3] for c in CITIES]
+
+    def point(self):
+        rnd = self._rnd
+        if rnd.random() < RURAL_SHARE:
+            return rnd.uniform(BOUNDS[0], BOUNDS[1]), rnd.uniform(BOUNDS[2], BOUNDS[3])
+        _, lat, lng, population = rnd.choices(CITIES, self._weights)[0]
+        # larger cities sprawl further
+        sigma_km = 3 + 4 * math.sqrt(population)
+        lat += rnd.gauss(0, sigma_km) / 111.32
+        lng += rnd.gauss(0, sigma_km) / (111.32 * math.cos(math.radians(lat)))
+        return lat, lng
+
+    def location(self):
+        return Location(*self.point())
+
+def entry_rows(count, rnd, points, users):
+    today = date.today()
+    rows = []
+    for _ in range(count):
+        lat, lng = points.point()
+        roll = rnd.random()
+        if roll < 0.1:
+            expires_at = today - timedelta(days=rnd.randrange(1, 60))
+        elif roll < 0.3:
+            expires_at = date(9999, 12, 31)
+        else:
+            expires_at = today + timedelta(days=rnd.randrange(1, 90))
+        rows.append((rnd.randrange(users), rnd.choices(LANGS, LANG_WEIGHTS)[0],
+                     rnd.choices(TYPES, TYPE_WEIGHTS)[0], rnd.choices(KINDS, KIND_WEIGHTS)[0],
+                     lat, lng, ' '.join(rnd.sample(WORDS, rnd.randrange(2, 6))),
+                     (today - timedelta(days=rnd.randrange(90))).strftime('%Y%m%d'), expires_at.strftime('%Y%m%d')))
+    return rows
+
+def subscription_rows(count, rnd, points, users):
+    inserted_at = date.today().strftime('%Y%m%d')
+    rows = []
+    for _ in range(count):
+        if rnd.random() < EVERYWHERE_SHARE:
+            lat, lng, distance = None, None, None
+        else:
+            (lat, lng), distance = points.point(), rnd.choices(DISTANCES, DISTANCE_WEIGHTS)[0] * 1000
+        rows.append((rnd.randrange(users), rnd.choices(LANGS, LANG_WEIGHTS)[0],
+                     rnd.choice(TYPES + ['all']), rnd.choice(KINDS + ['all']), lat, lng, distance, inserted_at,
+                     rnd.choices(DELIVERIES, DELIVERY_WEIGHTS)[0]))
+    return rows
+
+async def generate(path, entries, subscriptions, seed=42):
+    # creates the schema through tw_db and leaves the pool open on path;
+    # returns the seconds the two bulk imports took
+    rnd = random.Random(seed)
+    points = ClusteredPoints(rnd)
+    users = max(1, (entries + subscriptions) // 3)
+    tw_db.use_db(path)
+    await init_db()
+    rows = entry_rows(entries, rnd, points, users)
+    start = time.perf_counter()
+    await import_db_entries(rows)
+    entries_s = time.perf_counter() - start
+    rows = subscription_rows(subscriptions, rnd, points, users)
+    start = time.perf_counter()
+    await import_db_subscriptions(rows)
+    return entries_s, time.perf_counter() - start
+
+async def main(path, entries, subscriptions, seed):
+    await generate(path, entries, subscriptions, seed)
+    await close_db()
+    print(f'{entries} entries and {subscriptions} subscriptions written to {path}')
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'bench.sqlite'
+    entries = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    subscriptions = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 42
+    asyncio.run(main(path, entries, subscriptions, seed))
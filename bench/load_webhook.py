@@ -0,0 +1,104 @@
+# Load test for webhook mode: starts a stand-in for the Telegram Bot API,
+# runs tw_webhook.py against it and posts synthetic /list updates from many
+# chats. Reports how fast the workers turn updates into API calls.
+#
+#   python bench/load_webhook.py [updates] [chats] [workers]
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import asyncio
+import subprocess
+from aiohttp import web, ClientSession
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+TOKEN = '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls = 0
+        self.done = asyncio.Event()
+        self.expected = None
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post()) if request.can_read_body else {}
+        chat_id = int(data.get('chat_id', 1))
+        if method in ('sendMessage', 'sendPhoto'):
+            self.calls += 1
+            if self.expected is not None and self.calls >= self.expected:
+                self.done.set()
+        result = True
+        if method.startswith('send') or method.startswith('edit'):
+            result = {'message_id': self.calls, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                      'photo': [{'file_id': f'photo{self.calls}', 'file_unique_id': 'u', 'width': 800, 'height': 500}]}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'teilwas', 'username': 'teilwas_bot'}
+        return web.json_response({'ok': True, 'result': result})
+
+def update(update_id, chat_id):
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}', 'language_code': 'de'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': '/list',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        'chat': {'id': chat_id, 'type': 'private'}, 'from': user}}
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'webhook server did not come up on port {port}')
+
+async def main(updates, chats, workers):
+    fake = FakeTelegram()
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    api_port = free_port()
+    await web.TCPSite(runner, '127.0.0.1', api_port).start()
+
+    webhook_port = free_port()
+    env = dict(os.environ, TELEGRAM_API_TOKEN=TOKEN, TW_TELEGRAM_API_URL=f'http://127.0.0.1:{api_port}',
+               TW_WEBHOOK_HOST='127.0.0.1', TW_WEBHOOK_PORT=str(webhook_port), TW_WEBHOOK_WORKERS=str(workers))
+    env.pop('TW_WEBHOOK_URL', None)
+    server = subprocess.Popen([sys.executable, 'tw_webhook.py'], cwd=ROOT, env=env)
+    try:
+        await wait_for_port(webhook_port)
+        fake.expected = updates
+        sem = asyncio.Semaphore(64)
+        async with ClientSession() as session:
+            async def post(i):
+                async with sem:
+                    async with session.post(f'http://127.0.0.1:{webhook_port}/webhook', json=update(i, 1000 + i % chats)) as res:
+                        res.raise_for_status()
+            start = time.perf_counter()
+            await asyncio.gather(*[post(i) for i in range(updates)])
+            accepted = time.perf_counter() - start
+            await asyncio.wait_for(fake.done.wait(), timeout=600)
+            elapsed = time.perf_counter() - start
+        print(json.dumps({'updates': updates, 'chats': chats, 'workers': workers,
+                          'accept_seconds': round(accepted, 3), 'total_seconds': round(elapsed, 3),
+                          'updates_per_second': round(updates / elapsed, 1)}))
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        await runner.cleanup()
+
+if __name__ == '__main__':
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1)
+    asyncio.run(main(updates, chats, workers))
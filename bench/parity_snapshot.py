@@ -0,0 +1,123 @@
+# Checks that the snapshot search engine (tw_snapshot) finds the same entries
+# as the SQL path. A random mix of searches runs through both engines, all
+# result pages included, before and after single adds and deletes that the
+# snapshot follows incrementally. Entries within a few meters of the search
+# radius may be decided differently (haversine against PtDistWithin) and are
+# only counted. Exits with 1 if anything else differs.
+#
+#   python bench/parity_snapshot.py [--entries N] [--queries Q] [--seed S] [--db path]
+import os
+import sys
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from generate import generate, ClusteredPoints, TYPES, KINDS, WORDS
+import tw_db
+from tw_db import close_db, search_db_entry, search_db_entry_page, add_db_entry, delete_db_entry
+from tw_geo import haversine
+from tw_snapshot import EntrySnapshot
+
+RADII = [1, 5, 10, 25, 50, 100, 'search_everywhere']
+PAGE_SIZE = 10
+# relative distance difference tolerated at the edge of the radius
+EDGE = 0.005
+
+async def all_pages(query):
+    ids = []
+    cursor = None
+    while True:
+        rows, cursor = await search_db_entry_page(*query, after=cursor, limit=PAGE_SIZE)
+        ids += [row[0] for row in rows]
+        if cursor is None:
+            return ids
+
+async def run(query, snapshot):
+    tw_db.entry_snapshot = snapshot
+    return [row[0] for row in await search_db_entry(*query)], await all_pages(query)
+
+async def positions(ids):
+    # None for entries that are gone from the database
+    positions = {}
+    for entry_id in ids:
+        entry = await tw_db.get_db_entry(entry_id)
+        positions[entry_id] = (entry[5], entry[6]) if entry is not None else None
+    return positions
+
+async def compare(queries, snapshot, stats):
+    for query in queries:
+        sql_rows, sql_pages = await run(query, None)
+        snapshot_rows, snapshot_pages = await run(query, snapshot)
+        _, _, _, location, distance = query
+        for name, sql_ids, snapshot_ids in (('search', sql_rows, snapshot_rows), ('pages', sql_pages, snapshot_pages)):
+            stats['checks'] += 1
+            if len(set(snapshot_ids)) != len(snapshot_ids):
+                stats['errors'] += 1
+                print(f'{name} {query_label(query)}: the snapshot returned an entry twice')
+            differing = set(sql_ids) ^ set(snapshot_ids)
+            if location is None and name == 'pages' and not differing and sql_ids != snapshot_ids:
+                # newest first is exact, nearest first may swap near-equal distances
+                stats['errors'] += 1
+                print(f'{name} {query_label(query)}: same entries in a different order')
+            for entry_id, position in (await positions(differing)).items():
+                meters = int(distance) * 1000 if location is not None else None
+                if position is not None and meters is not None and \
+                        abs(haversine(location.latitude, location.longitude, *position) - meters) <= meters * EDGE:
+                    stats['edge'] += 1
+                else:
+                    stats['errors'] += 1
+                    engine = 'sql' if entry_id in sql_ids else 'snapshot'
+                    print(f'{name} {query_label(query)}: entry {entry_id} only found by {engine}')
+
+def query_label(query):
+    user_id, type, kind, location, distance = query
+    where = f'{location.latitude:.4f},{location.longitude:.4f} {distance}km' if location is not None else 'everywhere'
+    return f'user {user_id} {type}-{kind} {where}'
+
+def make_queries(rnd, points, users, count):
+    queries = []
+    for _ in range(count):
+        distance = rnd.choice(RADII)
+        location = points.location() if distance != 'search_everywhere' else None
+        queries.append((rnd.randrange(users), rnd.choice(TYPES + ['all']), rnd.choice(KINDS + ['all']), location, distance))
+    return queries
+
+async def main(args):
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='tw_parity_'), 'parity.sqlite')
+    await generate(path, args.entries, 0, args.seed)
+    rnd = random.Random(args.seed + 1)
+    points = ClusteredPoints(rnd)
+    users = max(1, args.entries // 3)
+    stats = {'checks': 0, 'edge': 0, 'errors': 0}
+    try:
+        snapshot = EntrySnapshot()
+        tw_db.entry_snapshot = snapshot
+        await tw_db.load_entry_snapshot()
+        await compare(make_queries(rnd, points, users, args.queries), snapshot, stats)
+        # changes the snapshot has to follow without a reload
+        expires_at = date.today() + timedelta(days=7)
+        added = [await add_db_entry(rnd.randrange(users), 'de', rnd.choice(TYPES), rnd.choice(KINDS), points.location(),
+                                    ' '.join(rnd.sample(WORDS, 3)), expires_at) for _ in range(args.changes)]
+        for entry_id in rnd.sample(added, len(added) // 2):
+            await delete_db_entry(entry_id)
+        rows, _ = await search_db_entry_page(-1, 'all', 'all', None, 'search_everywhere', limit=args.changes)
+        for row in rows[:args.changes // 4]:
+            await delete_db_entry(row[0])
+        await compare(make_queries(rnd, points, users, args.queries), snapshot, stats)
+    finally:
+        tw_db.entry_snapshot = None
+        await close_db()
+    print(f'{stats["checks"]} result sets compared, {stats["edge"]} entries at the edge of the radius, {stats["errors"]} differences')
+    return 1 if stats['errors'] else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200, help='searches per round, there are two rounds')
+    parser.add_argument('--changes', type=int, default=200, help='entries added between the rounds')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='where to generate the database, a fresh temporary file by default')
+    sys.exit(asyncio.run(main(parser.parse_args())))
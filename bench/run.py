@@ -0,0 +1,336 @@
+# End to end benchmark suite on synthetic data (see generate.py). Times bulk
+# imports and single inserts, entry searches at several radii and filters,
+# the same searches on the in-memory snapshot engine, subscription matching
+# (and checks the subscription index against the tables), map renders against
+# a local tile stand-in and the complete /add fan-out, then writes the results
+# as JSON for compare.py.
+#
+#   python bench/run.py [--entries N] [--subscriptions M] [--only search,render] [--out results.json]
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import date, timedelta
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from generate import generate, ClusteredPoints, TYPES, KINDS, WORDS
+import tw_db
+from tw_db import close_db, search_db_entry, search_db_entry_page, search_db_subscriptions, query_db_subscriptions, add_db_entry, add_db_subscription, \
+    match_new_entry, take_due_notifications, check_subscription_index, DIGEST_PERIODS
+from tw_i18n import load_translations, translate, use_locale
+from tw_notify import NotificationDispatcher
+from tw_snapshot import EntrySnapshot
+
+SECTIONS = ['insert', 'search', 'snapshot', 'subscriptions', 'render', 'fanout']
+RADII = [1, 5, 10, 50, 100]
+FILTERS = [('all', 'all'), ('food', 'all'), ('food', 'offer')]
+MARKERS = [1, 5, 10, 25, 50, 100]
+
+def summarize(samples, **extra):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'n': n,
+        'mean_ms': sum(samples) / n * 1000,
+        'p50_ms': samples[n // 2] * 1000,
+        'p95_ms': samples[min(n - 1, int(n * 0.95))] * 1000,
+        'max_ms': samples[-1] * 1000,
+        **extra,
+    }
+
+async def timed_calls(make_call, count):
+    samples = []
+    sizes = []
+    for _ in range(count):
+        call = make_call()
+        start = time.perf_counter()
+        result = await call
+        samples.append(time.perf_counter() - start)
+        sizes.append(len(result[0] if isinstance(result, tuple) else result))
+    return samples, sum(sizes) / len(sizes)
+
+def import_result(rows, seconds):
+    # per 1000 rows, so that compare.py reads it like the latency cases
+    per_1000 = seconds / max(rows, 1) * 1000 * 1000
+    return {'n': rows, 'rows_per_s': rows / seconds if seconds else None, 'mean_ms': per_1000, 'p50_ms': per_1000}
+
+async def bench_insert(results, points, rnd, imported, count):
+    results['import/entries'] = import_result(*imported[0])
+    results['import/subscriptions'] = import_result(*imported[1])
+    expires_at = date.today() + timedelta(days=7)
+    samples = []
+    for _ in range(count):
+        location = points.location()
+        start = time.perf_counter()
+        await add_db_entry(rnd.randrange(1 << 30), 'de', rnd.choice(TYPES), rnd.choice(KINDS), location, 'bench entry', expires_at)
+        samples.append(time.perf_counter() - start)
+    results['insert/add_db_entry'] = summarize(samples)
+    samples = []
+    for _ in range(count):
+        location = points.location()
+        start = time.perf_counter()
+        await add_db_subscription(rnd.randrange(1 << 30), 'de', rnd.choice(TYPES), rnd.choice(KINDS), location, rnd.choice([1, 10, 50]))
+        samples.append(time.perf_counter() - start)
+    results['insert/add_db_subscription'] = summarize(samples)
+
+async def bench_search(results, points, rnd, queries):
+    for km in RADII:
+        for type, kind in FILTERS:
+            samples, rows = await timed_calls(lambda: search_db_entry(-1, type, kind, points.location(), km), queries)
+            results[f'search/{km}km/{type}-{kind}'] = summarize(samples, mean_rows=rows)
+        samples, rows = await timed_calls(lambda: search_db_entry_page(-1, 'all', 'all', points.location(), km), queries)
+        results[f'search_page/{km}km/all-all'] = summarize(samples, mean_rows=rows)
+        # bm25 ranked keyword pages, one word and a prefix of two
+        samples, rows = await timed_calls(lambda: search_db_entry_page(-1, 'all', 'all', points.location(), km,
+                                                                       keywords=rnd.choice(WORDS)), queries)
+        results[f'search_keywords/{km}km/one_word'] = summarize(samples, mean_rows=rows)
+        samples, rows = await timed_calls(lambda: search_db_entry_page(-1, 'all', 'all', points.location(), km,
+                                                                       keywords=' '.join(w[:4] for w in rnd.sample(WORDS, 2))), queries)
+        results[f'search_keywords/{km}km/two_prefixes'] = summarize(samples, mean_rows=rows)
+    samples, rows = await timed_calls(lambda: search_db_entry_page(-1, 'all', 'all', None, 'search_everywhere',
+                                                                   keywords=rnd.choice(WORDS)), queries)
+    results['search_keywords/everywhere/one_word'] = summarize(samples, mean_rows=rows)
+
+async def bench_snapshot(results, points, rnd, queries):
+    # result pages from both engines for the same query mix; qps is for one
+    # caller issuing them back to back
+    def page(type, kind, km):
+        if km is None:
+            return search_db_entry_page(rnd.randrange(1 << 30), type, kind, None, 'search_everywhere')
+        return search_db_entry_page(rnd.randrange(1 << 30), type, kind, points.location(), km)
+    snapshot = EntrySnapshot()
+    previous = tw_db.entry_snapshot
+    try:
+        tw_db.entry_snapshot = snapshot
+        start = time.perf_counter()
+        await tw_db.load_entry_snapshot()
+        results['snapshot/load'] = summarize([time.perf_counter() - start], rows=len(snapshot))
+        for km in RADII + [None]:
+            case = f'{km}km' if km is not None else 'everywhere'
+            for type, kind in FILTERS:
+                for engine, engine_snapshot in (('sql', None), ('snapshot', snapshot)):
+                    tw_db.entry_snapshot = engine_snapshot
+                    samples, rows = await timed_calls(lambda: page(type, kind, km), queries)
+                    results[f'snapshot/{case}/{type}-{kind}/{engine}'] = summarize(samples, mean_rows=rows, qps=len(samples) / sum(samples))
+    finally:
+        tw_db.entry_snapshot = previous
+
+async def bench_subscriptions(results, points, rnd, queries):
+    def query():
+        return rnd.randrange(1 << 30), rnd.choice(TYPES), rnd.choice(KINDS), points.location()
+    samples, matches = await timed_calls(lambda: search_db_subscriptions(*query()), queries)
+    results['subscriptions/index'] = summarize(samples, mean_matches=matches)
+    samples, matches = await timed_calls(lambda: query_db_subscriptions(*query()), queries)
+    results['subscriptions/sql'] = summarize(samples, mean_matches=matches)
+    # the index followed the imports and the insert section row by row, it
+    # has to agree with the tables
+    check = {name: len(ids) for name, ids in (await check_subscription_index()).items()}
+    results['subscriptions/index'].update(check)
+    if any(check.values()):
+        print(f'subscription index differs from the tables: {check}', file=sys.stderr)
+
+def blank_tile():
+    # a plain grey 256x256 PNG
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    raw = b''.join(b'\x00' + b'\xdd' * 256 for _ in range(256))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 256, 256, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+def start_tile_server(latency):
+    tile = blank_tile()
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(tile)))
+            self.end_headers()
+            self.wfile.write(tile)
+
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def use_tile_server(server, cache_dir):
+    # tw_render and tw_tiles read these at import, render pool processes inherit them
+    os.environ['TW_TILE_URL'] = f'http://127.0.0.1:{server.server_address[1]}/$z/$x/$y.png'
+    os.environ['TW_TILE_CACHE_DIR'] = cache_dir
+
+def nearby(rnd, center, count, sigma_km=3):
+    lat, lng = center
+    return [(lat + rnd.gauss(0, sigma_km) / 111.32, lng + rnd.gauss(0, sigma_km) / 71.0) for _ in range(count)]
+
+async def bench_render(results, points, rnd, renders):
+    import tw_map
+    for count in MARKERS:
+        # the first render of each size fetches most tiles, it isn't timed
+        await tw_map.render_map(nearby(rnd, points.point(), count))
+        samples = []
+        for _ in range(renders):
+            locations = nearby(rnd, points.point(), count)
+            tw_map.png_cache.clear()
+            start = time.perf_counter()
+            await tw_map.render_map(locations)
+            samples.append(time.perf_counter() - start)
+        results[f'render/{count}_markers'] = summarize(samples)
+
+async def fan_out(dispatcher, sends, user_id, type, kind, location, description):
+    # the tail of process_add_expires_at with Telegram replaced by sends;
+    # returns the number of instant notifications
+    import tw_map
+    entry_id = await add_db_entry(user_id, 'de', type, kind, location, description, date.today() + timedelta(days=7))
+    locations = [(location.latitude, location.longitude)]
+    instant = 0
+    for sub in await match_new_entry(entry_id, user_id, type, kind, location, '[bench](tg://user?id=1)'):
+        instant += 1
+        with use_locale(sub[1]):
+            msg = '\n'.join([translate('subscription_incoming', link='[bench](tg://user?id=1)'), translate('details'),
+                             translate(type) + ' - ' + translate(kind), description])
+            caption = translate('map_locations')
+        async def send_map(chat_id=sub[0], caption=caption):
+            await tw_map.map_photo(locations)
+            await sends(chat_id, caption)
+        await dispatcher.submit(sub[0], partial(sends, sub[0], msg), send_map)
+    return instant
+
+async def flush_digests(dispatcher, sends):
+    # flush_digests of the bot, due or not; returns digests and entries sent
+    import tw_map
+    digests = {}
+    for delivery in DIGEST_PERIODS:
+        for user_id, user_lang, link, entry in await take_due_notifications(delivery, -1):
+            digests.setdefault((user_id, user_lang), []).append((link, entry))
+    for (user_id, user_lang), matches in digests.items():
+        with use_locale(user_lang):
+            text = '\n\n'.join([translate('digest_incoming', count=str(len(matches)))] +
+                                [f'{translate(entry[3])} - {translate(entry[4])}: {entry[7]} {link}' for link, entry in matches])
+        locations = [(entry[5], entry[6]) for _, entry in matches]
+        async def send_map(chat_id=user_id, locations=locations):
+            await tw_map.map_photo(locations)
+            await sends(chat_id, '')
+        await dispatcher.submit(user_id, partial(sends, user_id, text), send_map)
+    return len(digests), sum(len(matches) for matches in digests.values())
+
+async def bench_fanout(results, points, rnd, adds, send_latency):
+    async def sends(chat_id, text):
+        await asyncio.sleep(send_latency)
+    handler = []
+    total = []
+    notified = []
+    for _ in range(adds):
+        # rate limits would only measure themselves
+        dispatcher = NotificationDispatcher(global_rate=1e9, chat_rate=1e9)
+        dispatcher.start()
+        start = time.perf_counter()
+        notified.append(await fan_out(dispatcher, sends, rnd.randrange(1 << 30), rnd.choice(TYPES), rnd.choice(KINDS),
+                                      points.location(), 'bench entry'))
+        handler.append(time.perf_counter() - start)
+        await dispatcher.stop(drain=True)
+        total.append(time.perf_counter() - start)
+    mean_notified = sum(notified) / len(notified)
+    results['fanout/handler'] = summarize(handler, mean_notified=mean_notified)
+    results['fanout/delivered'] = summarize(total, mean_notified=mean_notified)
+    # everything the adds queued for hourly and daily subscribers, in one go
+    dispatcher = NotificationDispatcher(global_rate=1e9, chat_rate=1e9)
+    dispatcher.start()
+    start = time.perf_counter()
+    digests, matches = await flush_digests(dispatcher, sends)
+    await dispatcher.stop(drain=True)
+    results['fanout/digests'] = summarize([time.perf_counter() - start], digests=digests, digested_matches=matches)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+async def main(args):
+    sections = args.only.split(',') if args.only else SECTIONS
+    workdir = tempfile.mkdtemp(prefix='tw_bench_')
+    rnd = random.Random(args.seed + 1)
+    points = ClusteredPoints(rnd)
+    load_translations(os.path.join(ROOT, 'translations'))
+    tile_server = None
+    if 'render' in sections or 'fanout' in sections:
+        tile_server = start_tile_server(args.tile_latency / 1000)
+        use_tile_server(tile_server, os.path.join(workdir, 'tiles'))
+
+    start = time.perf_counter()
+    entries_s, subscriptions_s = await generate(args.db or os.path.join(workdir, 'bench.sqlite'), args.entries, args.subscriptions, args.seed)
+    generated = time.perf_counter() - start
+    print(f'generated {args.entries} entries and {args.subscriptions} subscriptions in {generated:.1f}s', file=sys.stderr)
+
+    results = {}
+    try:
+        if 'insert' in sections:
+            await bench_insert(results, points, rnd, [(args.entries, entries_s), (args.subscriptions, subscriptions_s)], args.inserts)
+        if 'search' in sections:
+            await bench_search(results, points, rnd, args.queries)
+        if 'snapshot' in sections:
+            await bench_snapshot(results, points, rnd, args.queries)
+        if 'subscriptions' in sections:
+            await bench_subscriptions(results, points, rnd, args.queries)
+        if 'render' in sections:
+            await bench_render(results, points, rnd, args.renders)
+        if 'fanout' in sections:
+            await bench_fanout(results, points, rnd, args.adds, args.send_latency / 1000)
+    finally:
+        if 'tw_map' in sys.modules:
+            sys.modules['tw_map'].shutdown_renderer()
+        await close_db()
+        if tile_server is not None:
+            tile_server.shutdown()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'entries': args.entries,
+            'subscriptions': args.subscriptions,
+            'seed': args.seed,
+            'queries': args.queries,
+            'generate_s': generated,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--subscriptions', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--queries', type=int, default=200, help='searches and matches per case')
+    parser.add_argument('--inserts', type=int, default=200, help='single add_db_entry and add_db_subscription calls')
+    parser.add_argument('--renders', type=int, default=10, help='timed renders per marker count')
+    parser.add_argument('--adds', type=int, default=50, help='simulated /add fan-outs')
+    parser.add_argument('--tile-latency', type=float, default=0, help='ms the tile stand-in waits per tile')
+    parser.add_argument('--send-latency', type=float, default=0, help='ms every simulated Telegram send takes')
+    parser.add_argument('--db', help='where to generate the database, a fresh temporary file by default')
+    parser.add_argument('--only', help='comma separated subset of ' + ','.join(SECTIONS))
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    asyncio.run(main(parser.parse_args()))
@@ -2,12 +2,16 @@ import logging
 import asyncio
 import re
 import os
-import i18n
+import sys
 from datetime import datetime, timedelta
+from functools import partial
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from tw_storage import SQLiteStorage
+from tw_i18n import load_translations, translate as _, parse_key, current_locale, use_locale, LocaleMiddleware
 from aiogram.dispatcher import FSMContext, filters
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
@@ -15,30 +19,49 @@ from aiogram.types import ParseMode
 from aiogram.utils import executor
 import aiogram.utils.markdown as md
 from aiogram.types.message import ContentType
+from aiogram.utils.exceptions import BadRequest
+from aiogram.utils.callback_data import CallbackData
 
-from tw_map import render_map
-from tw_db import search_db_entry, delete_db_entry, search_db_own_entry, add_db_entry, init_db, add_db_subscription, search_db_subscriptions, search_db_own_subscriptions, delete_db_subscription
+from tw_notify import NotificationDispatcher
+from tw_metrics import MetricsBot, MetricsMiddleware, Gauge, CallbackGauge, collectors, start_metrics_server, set_ready, METRICS_PORT
+from tw_map import map_photo, remember_file_id, forget_file_id, shutdown_renderer, prewarm_renderer, MAP_PREWARM
+from tw_startup import phase, report
+from tw_db import DB, match_query, search_db_entry_page, get_db_entry, delete_db_entry, search_db_own_entry, add_db_entry, init_db, close_db, purge_expired_entries, refresh_subscription_index, refresh_entry_snapshot, SEARCH_ENGINE, PURGE_INTERVAL, add_db_subscription, search_db_own_subscriptions, delete_db_subscription, match_new_entry, take_due_notifications, DELIVERY_MODES, DIGEST_PERIODS
 
 load_dotenv()
-i18n.load_path.append('translations')
-i18n.set('enable_memoization', True)
-i18n.set('fallback', 'en')
-
-def _(key, **kwargs):
-    return i18n.t(f'tw_bot.{key}', **kwargs)
-
-def search_i18n_key(text, keys):
-    for k in keys:
-        if _(k) == text:
-            return k
-    return None
+load_translations()
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=os.environ.get('TELEGRAM_API_TOKEN'))
+TELEGRAM_API_URL = os.environ.get('TW_TELEGRAM_API_URL')
+bot = MetricsBot(token=os.environ.get('TELEGRAM_API_TOKEN'), server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+
+# set for each worker process in webhook mode (see tw_webhook.py)
+WORKER_INDEX = os.environ.get('TW_WORKER_INDEX')
+SUBSCRIPTION_REFRESH_INTERVAL = int(os.environ.get('TW_SUBSCRIPTION_REFRESH_INTERVAL', '30'))
+DIGEST_CHECK_INTERVAL = int(os.environ.get('TW_DIGEST_CHECK_INTERVAL', '300'))
 
-storage = MemoryStorage()
+if os.environ.get('TW_FSM_STORAGE', 'sqlite') == 'memory':
+    storage = MemoryStorage()
+else:
+    storage = SQLiteStorage(DB)
 dp = Dispatcher(bot, storage=storage)
+dp.middleware.setup(LocaleMiddleware())
+dp.middleware.setup(MetricsMiddleware())
+notifications = NotificationDispatcher()
+
+CallbackGauge('tw_notification_queue_size', 'Notifications waiting to be sent', notifications.qsize)
+FSM_STATES = Gauge('tw_fsm_states', 'Live conversations by FSM state', ['state'])
+
+async def count_fsm_states():
+    if isinstance(storage, SQLiteStorage):
+        FSM_STATES.replace({(state,): count for state, count in (await storage.count_states()).items()})
+
+collectors.append(count_fsm_states)
+
+MESSAGE_LIMIT = 4096
+RESULTS_PAGE_SIZE = int(os.environ.get('TW_RESULTS_PAGE_SIZE', '10'))
+page_cb = CallbackData('page', 'source', 'page')
 
 def format_expires_at(expires):
     expires_str = None
@@ -51,52 +74,126 @@ def format_expires_at(expires):
 
 def clean_for_md(s):
     return re.sub(r'([\!\.\(\)\=])', r'\\\g<1>', s)
+
+async def send_map(chat_id, locations, caption, first=1):
+    key, photo = await map_photo(locations, first)
+    try:
+        sent = await bot.send_photo(chat_id, photo, caption)
+    except BadRequest:
+        if not isinstance(photo, str):
+            raise
+        # the remembered file_id is no longer accepted, upload it again
+        forget_file_id(key)
+        key, photo = await map_photo(locations, first)
+        sent = await bot.send_photo(chat_id, photo, caption)
+    remember_file_id(key, sent)
     
-async def show_results(bot, message, results):
-    num = 1
-    locations = []
-    for result in results:
-        expires_str = format_expires_at(result[9])
-        locations.append((result[5], result[6]))
+def state_location(data):
+    # locations come back from the persistent FSM storage as plain dicts
+    location = data.get('location')
+    if isinstance(location, dict):
+        location = types.Location(**location)
+    return location
+
+def format_result(num, result):
+    expires_str = format_expires_at(result[9])
+    return md.text(
+        md.text('\\#', md.bold(num)),
+        md.text(md.bold(_('type') + ':'), _(result[3]) + ' \\- ' + _(result[4])),
+        md.text(md.bold(_('expires_at') + ':'), clean_for_md(expires_str)),
+        md.text(md.bold(_('description') + ':')),
+        md.text(clean_for_md(result[7])),
+        sep='\n',
+    )
+
+def format_subscription(num, result):
+    return md.text(
+        md.text('\\#', md.bold(num)),
+        md.text(md.bold(_('type') + ':'), _(result[3]) + ' \\- ' + _(result[4])),
+        md.text(md.bold(_('delivery') + ':'), _('delivery_' + result[10])),
+        sep='\n',
+    )
+
+def pack_messages(blocks, sep='\n\n'):
+    # joins formatted entries into as few messages as fit Telegram's limit
+    messages = []
+    current = ''
+    for block in blocks:
+        block = block[:MESSAGE_LIMIT]
+        if current and len(current) + len(sep) + len(block) > MESSAGE_LIMIT:
+            messages.append(current)
+            current = ''
+        current = current + sep + block if current else block
+    if current:
+        messages.append(current)
+    return messages
+
+async def show_page(chat_id, page_results, first, more, source, page, format, caption):
+    blocks = [format(first + num + 1, result) for num, result in enumerate(page_results)]
+    markup = None
+    if more:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(_('more_results'), callback_data=page_cb.new(source=source, page=page + 1)))
+    messages = pack_messages(blocks)
+    for idx, text in enumerate(messages):
         await bot.send_message(
-            message.chat.id,
-            md.text(
-                md.text('\\#', md.bold(num)),
-                md.text(md.bold(_('type') + ':'), _(result[3]) + ' \\- ' + _(result[4])),
-                md.text(md.bold(_('expires_at') + ':'), clean_for_md(expires_str)),
-                md.text(md.bold(_('description') + ':')),
-                md.text(clean_for_md(result[7])),
-                sep='\n',
-            ),
-            reply_markup=types.ReplyKeyboardRemove(),
-            parse_mode='MarkdownV2'#ParseMode.MARKDOWN,
-        )
-        num += 1
-    await types.ChatActions.upload_photo()
-    map = await render_map(locations)
-    await message.answer_photo(map, _('map_locations'))
-
-async def show_subscriptions(bot, message, results):
-    num = 1
-    locations = []
-    for result in results:
-        if result[5] is not None:
-            locations.append((result[5], result[6]))
-        await bot.send_message(
-            message.chat.id,
-            md.text(
-                md.text('\\#', md.bold(num)),
-                md.text(md.bold(_('type') + ':'), _(result[3]) + ' \\- ' + _(result[4])),
-                sep='\n',
-            ),
-            reply_markup=types.ReplyKeyboardRemove(),
+            chat_id,
+            text,
+            reply_markup=markup if idx == len(messages) - 1 else None,
             parse_mode='MarkdownV2'#ParseMode.MARKDOWN,
         )
-        num += 1
+    locations = [(result[5], result[6]) for result in page_results if result[5] is not None]
     if len(locations) > 0:
         await types.ChatActions.upload_photo()
-        map = await render_map(locations)
-        await message.answer_photo(map, _('map_subscription_locations'))
+        await send_map(chat_id, locations, caption, first + 1)
+
+async def show_results(chat_id, results, source, page=0):
+    first = page * RESULTS_PAGE_SIZE
+    more = first + RESULTS_PAGE_SIZE < len(results)
+    await show_page(chat_id, results[first:first + RESULTS_PAGE_SIZE], first, more, source, page, format_result, _('map_locations'))
+
+async def show_subscriptions(chat_id, results, source, page=0):
+    first = page * RESULTS_PAGE_SIZE
+    more = first + RESULTS_PAGE_SIZE < len(results)
+    await show_page(chat_id, results[first:first + RESULTS_PAGE_SIZE], first, more, source, page, format_subscription, _('map_subscription_locations'))
+
+async def fetch_search_page(user_id, data):
+    # search results are fetched from the database one keyset page at a time,
+    # the state only remembers the ids shown so far and the next cursor
+    rows, cursor = await search_db_entry_page(user_id, data['type'], data['kind'], state_location(data), data['distance'], data.get('cursor'), RESULTS_PAGE_SIZE, data.get('keywords'))
+    first = len(data.get('selection', []))
+    data['selection'] = data.get('selection', []) + [row[0] for row in rows]
+    data['cursor'] = cursor
+    return rows, first
+
+async def show_search_page(chat_id, rows, first, data, page=0):
+    await show_page(chat_id, rows, first, data['cursor'] is not None, 'search', page, format_result, _('map_locations'))
+
+@dp.callback_query_handler(page_cb.filter(), state='*')
+async def process_results_page(query: types.CallbackQuery, callback_data: dict, state: FSMContext):
+    source = callback_data['source']
+    page = int(callback_data['page'])
+    await query.message.edit_reply_markup()
+    await query.answer()
+    if source == 'search':
+        if await state.get_state() != SearchForm.selection.state:
+            return
+        async with state.proxy() as data:
+            if data.get('cursor') is not None:
+                rows, first = await fetch_search_page(query.from_user.id, data)
+                if len(rows) > 0:
+                    await show_search_page(query.message.chat.id, rows, first, data, page)
+        return
+    if source in ('entries', 'selected_entries'):
+        results = await search_db_own_entry(query.from_user.id)
+    else:
+        results = await search_db_own_subscriptions(query.from_user.id)
+    if page * RESULTS_PAGE_SIZE >= len(results):
+        return
+    if source in ('entries', 'selected_entries'):
+        await show_results(query.message.chat.id, results, source, page)
+    else:
+        await show_subscriptions(query.message.chat.id, results, source, page)
 
 @dp.message_handler(state='*', commands=['cancel', 'c'])
 @dp.message_handler(Text(equals='cancel', ignore_case=True), state='*')
@@ -106,15 +203,13 @@ async def cancel_handler(message: types.Message, state: FSMContext):
         return
     logging.info('Cancelling state %r', current_state)
     await state.finish()
-    i18n.set('locale', message.from_user.locale.language)
     await message.reply(_('cancel_state'), reply_markup=types.ReplyKeyboardRemove())
 
 @dp.message_handler(commands=['list', 'l'])
 async def cmd_list(message: types.Message, state: FSMContext):
     results = await search_db_own_entry(message.from_user.id)
-    i18n.set('locale', message.from_user.locale.language)
     if len(results) > 0:
-        await show_results(bot, message, results)
+        await show_results(message.chat.id, results, 'entries')
     else:
         await message.answer(_('no_entries_found'))
 
@@ -124,10 +219,9 @@ class DeleteSubscriptionForm(StatesGroup):
 @dp.message_handler(commands=['delete_subscription', 'ds'])
 async def cmd_delete_subscription(message: types.Message, state: FSMContext):
     results = await search_db_own_subscriptions(message.from_user.id)
-    i18n.set('locale', message.from_user.locale.language)
     if len(results) > 0:
-        await state.update_data(selection=results)
-        await show_subscriptions(bot, message, results)
+        await state.update_data(selection=[result[0] for result in results])
+        await show_subscriptions(message.chat.id, results, 'selected_subscriptions')
         await DeleteSubscriptionForm.next()
         await message.answer(_('delete_which'))
     else:
@@ -140,10 +234,9 @@ class DeleteForm(StatesGroup):
 @dp.message_handler(commands=['delete', 'd'])
 async def cmd_delete(message: types.Message, state: FSMContext):
     results = await search_db_own_entry(message.from_user.id)
-    i18n.set('locale', message.from_user.locale.language)
     if len(results) > 0:
-        await state.update_data(selection=results)
-        await show_results(bot, message, results)
+        await state.update_data(selection=[result[0] for result in results])
+        await show_results(message.chat.id, results, 'selected_entries')
         await DeleteForm.next()
         await message.answer(_('delete_which'))
     else:
@@ -151,12 +244,10 @@ async def cmd_delete(message: types.Message, state: FSMContext):
         await state.finish()
 
 async def process_delete_selection_meta(message: types.Message, state: FSMContext, func):
-    i18n.set('locale', message.from_user.locale.language)
     async with state.proxy() as data:
         sel = int(message.text) - 1
         if sel >= 0 and sel < len(data['selection']):
-            result = data['selection'][sel]
-            result_uid = result[0]
+            result_uid = data['selection'][sel]
             func(result_uid)
             await message.answer(_('delete_success', index=str(sel + 1)))
             await state.finish()
@@ -175,7 +266,6 @@ async def process_delete_subscription_selection(message: types.Message, state: F
 @dp.message_handler(lambda message: not message.text.isdigit(), state=DeleteForm.selection)
 @dp.message_handler(lambda message: not message.text.isdigit(), state=DeleteSubscriptionForm.selection)
 async def process_delete_selection_invalid(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     max = 0
     async with state.proxy() as data:
         max = len(data['selection'])
@@ -184,13 +274,13 @@ async def process_delete_selection_invalid(message: types.Message, state: FSMCon
 class SearchForm(StatesGroup):
     type = State()
     kind = State()
+    keywords = State()
     distance = State()
     location = State()
     selection = State()
     
 @dp.message_handler(commands=['search', 's'])
 async def cmd_search(message: types.Message):
-    i18n.set('locale', message.from_user.locale.language)
     await SearchForm.type.set()
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
     markup.add(_('food'), _('thing'), _('clothes'), _('skill'))
@@ -202,33 +292,37 @@ class SubscribeForm(StatesGroup):
     kind = State()
     distance = State()
     location = State()
+    delivery = State()
     
 @dp.message_handler(commands=['subscribe', 'sub', 'add_subscription', 'as'])
 async def cmd_subscribe(message: types.Message):
-    i18n.set('locale', message.from_user.locale.language)
     await SubscribeForm.type.set()
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
     markup.add(_('food'), _('thing'), _('clothes'), _('skill'))
     markup.add(_('all'))
     await message.answer(_('subscribe_what_type'), reply_markup=markup)
 
+async def ask_delivery(message):
+    await SubscribeForm.delivery.set()
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
+    markup.add(*[_('delivery_' + mode) for mode in DELIVERY_MODES])
+    await message.answer(_('subscribe_delivery'), reply_markup=markup)
+
 async def subscribe_entries(message, data, state):
-    await add_db_subscription(message.from_user.id, message.from_user.locale.language, data['type'], data['kind'], data['location'], data['distance'])
+    await add_db_subscription(message.from_user.id, current_locale.get(), data['type'], data['kind'], state_location(data), data['distance'], data['delivery'])
     await message.answer(_('subscribe_success'), reply_markup=types.ReplyKeyboardRemove())
     await state.finish()
 
 @dp.message_handler(commands=['list_subscriptions', 'ls'])
 async def cmd_list(message: types.Message, state: FSMContext):
     results = await search_db_own_subscriptions(message.from_user.id)
-    i18n.set('locale', message.from_user.locale.language)
     if len(results) > 0:
-        await show_subscriptions(bot, message, results)
+        await show_subscriptions(message.chat.id, results, 'subscriptions')
     else:
         await message.answer(_('no_entries_found'))
 
 async def preprocess_search_type(message, state):
-    i18n.set('locale', message.from_user.locale.language)
-    i18n_key = search_i18n_key(message.text, ['food', 'thing', 'clothes', 'skill', 'all'])
+    i18n_key = parse_key(message.text, ['food', 'thing', 'clothes', 'skill', 'all'])
     if not i18n_key:
         return await message.answer(_('invalid_type'))
     await state.update_data(type=i18n_key)
@@ -250,24 +344,27 @@ async def process_search_type(message: types.Message, state: FSMContext):
     await message.answer(_('search_what_kind'), reply_markup=markup)
 
 async def search_entries(message, data, state):
-    i18n.set('locale', message.from_user.locale.language)
-    results = await search_db_entry(message.from_user.id, data['type'], data['kind'], data['location'], data['distance'])
-    if len(results) > 0:
-        data['selection'] = results
-        await SearchForm.next()
-        await message.answer(_('search_found_sth', count=str(len(results))) + ':', reply_markup=types.ReplyKeyboardRemove())
-        await show_results(bot, message, results)
+    data['selection'] = []
+    data['cursor'] = None
+    rows, first = await fetch_search_page(message.from_user.id, data)
+    if len(rows) > 0:
+        await SearchForm.selection.set()
+        count = str(len(rows)) + ('+' if data['cursor'] is not None else '')
+        await message.answer(_('search_found_sth', count=count) + ':', reply_markup=types.ReplyKeyboardRemove())
+        await show_search_page(message.chat.id, rows, first, data)
         await message.answer(_('search_pick_one'))
     else:
         await message.answer(_('search_no_entries_found'), reply_markup=types.ReplyKeyboardRemove())
         await state.finish()
 
 async def preprocess_search_kind(message, state):
-    i18n.set('locale', message.from_user.locale.language)
-    i18n_key = search_i18n_key(message.text, ['offer', 'search', 'all'])
+    i18n_key = parse_key(message.text, ['offer', 'search', 'all'])
     if not i18n_key:
         return await message.answer(_('invalid_kind'))
     await state.update_data(kind=i18n_key)
+    return distance_markup()
+
+def distance_markup():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
     markup.add('5', '10', '50', '100')
     markup.add(_('search_everywhere'))
@@ -275,9 +372,22 @@ async def preprocess_search_kind(message, state):
 
 @dp.message_handler(state=SearchForm.kind)
 async def process_search_kind(message: types.Message, state: FSMContext):
-    markup = await preprocess_search_kind(message, state)
+    await preprocess_search_kind(message, state)
+    await SearchForm.next()
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
+    markup.add(_('search_any_keywords'))
+    await message.answer(_('search_keywords'), reply_markup=markup)
+
+@dp.message_handler(state=SearchForm.keywords)
+async def process_search_keywords(message: types.Message, state: FSMContext):
+    keywords = None
+    if not parse_key(message.text, ['search_any_keywords']):
+        if match_query(message.text) is None:
+            return await message.answer(_('invalid_keywords'))
+        keywords = message.text
+    await state.update_data(keywords=keywords)
     await SearchForm.next()
-    await message.answer(_('search_distance'), reply_markup=markup)
+    await message.answer(_('search_distance'), reply_markup=distance_markup())
 
 @dp.message_handler(state=SubscribeForm.kind)
 async def process_subscription_kind(message: types.Message, state: FSMContext):
@@ -287,7 +397,6 @@ async def process_subscription_kind(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=SearchForm.distance)
 async def process_search_distance(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     async with state.proxy() as data:
         if message.text == _('search_everywhere'): 
             data['distance'] = 'search_everywhere'
@@ -303,13 +412,11 @@ async def process_search_distance(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=SubscribeForm.distance)
 async def process_subscription_distance(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     async with state.proxy() as data:
         if message.text == _('search_everywhere'): 
             data['distance'] = 'search_everywhere'
             data['location'] = None
-            await SubscribeForm.next()
-            await subscribe_entries(message, data, state)
+            await ask_delivery(message)
         elif message.text.isdigit():
             data['distance'] = message.text
             await SubscribeForm.next()
@@ -319,16 +426,22 @@ async def process_subscription_distance(message: types.Message, state: FSMContex
 
 @dp.message_handler(content_types=ContentType.LOCATION, state=SearchForm.location)
 async def process_search_location(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     async with state.proxy() as data:
         data['location'] = message.location
         await search_entries(message, data, state)
 
 @dp.message_handler(content_types=ContentType.LOCATION, state=SubscribeForm.location)
 async def process_subscription_location(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
+    await state.update_data(location=message.location)
+    await ask_delivery(message)
+
+@dp.message_handler(state=SubscribeForm.delivery)
+async def process_subscription_delivery(message: types.Message, state: FSMContext):
+    i18n_key = parse_key(message.text, ['delivery_' + mode for mode in DELIVERY_MODES])
+    if not i18n_key:
+        return await message.answer(_('invalid_delivery'))
     async with state.proxy() as data:
-        data['location'] = message.location
+        data['delivery'] = i18n_key[len('delivery_'):]
         await subscribe_entries(message, data, state)
 
 @dp.message_handler(content_types=ContentType.ANY, state=SearchForm.location)
@@ -338,16 +451,17 @@ async def process_search_location_invalid(message: types.Message, state: FSMCont
 
 @dp.message_handler(lambda message: message.text.isdigit(), state=SearchForm.selection)
 async def process_search_selection(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     async with state.proxy() as data:
         sel = int(message.text) - 1
-        if sel >= 0 and sel < len(data['selection']) + 1:
-            result = data['selection'][sel]
+        if sel >= 0 and sel < len(data['selection']):
+            result = await get_db_entry(data['selection'][sel])
+            if result is None:
+                return await message.answer(_('search_entry_gone'))
             await message.answer(_('search_picked', index=str(sel + 1)) + '\n' + _('search_sent_notification'))
             user = str(message.from_user.id)
             link = f'[{message.from_user.mention}](tg://user?id={user})'
-            i18n.set('locale', result[2])
-            text = _('search_notification', desc=result[7], link=link)
+            with use_locale(result[2]):
+                text = _('search_notification', desc=result[7], link=link)
             await bot.send_message(
                     result[1],
                     text,
@@ -376,14 +490,12 @@ class AddForm(StatesGroup):
 async def cmd_add(message: types.Message):
     await AddForm.type.set()
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-    i18n.set('locale', message.from_user.locale.language)
     markup.add(_('food'), _('thing'), _('clothes'), _('skill'))
     await message.answer(_('add_what_type'), reply_markup=markup)
 
 @dp.message_handler(state=AddForm.type)
 async def process_add_type(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
-    i18n_key = search_i18n_key(message.text, ['food', 'thing', 'clothes', 'skill'])
+    i18n_key = parse_key(message.text, ['food', 'thing', 'clothes', 'skill'])
     if not i18n_key:
         return await message.answer(_('invalid_type'))
     else:
@@ -395,8 +507,7 @@ async def process_add_type(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=AddForm.kind)
 async def process_add_kind(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
-    i18n_key = search_i18n_key(message.text, ['offer', 'search'])
+    i18n_key = parse_key(message.text, ['offer', 'search'])
     if not i18n_key:
         return await message.answer(_('invalid_kind'))
     else:   
@@ -406,7 +517,6 @@ async def process_add_kind(message: types.Message, state: FSMContext):
 
 @dp.message_handler(content_types=ContentType.LOCATION, state=AddForm.location)
 async def process_add_location(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     async with state.proxy() as data:
         data['location'] = message.location
         await AddForm.next()
@@ -418,7 +528,6 @@ async def process_add_location_invalid(message: types.Message, state: FSMContext
 
 @dp.message_handler(state=AddForm.description)
 async def process_add_description(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     desc = re.sub(r'[^A-Za-z0-9\.,;:!\(\)\s]', '', message.text)
     await state.update_data(description=desc)
     await AddForm.next()
@@ -426,7 +535,6 @@ async def process_add_description(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=AddForm.expires_at)
 async def process_add_expires_at(message: types.Message, state: FSMContext):
-    i18n.set('locale', message.from_user.locale.language)
     if not re.search(r'^([0-9]{1,2})\.([0-9]{1,2})\.([0-9]{4})$|^([0-9]+)$', message.text) and message.text.lower() != _('add_expiration_never').lower():
         return await message.answer(_('add_invalid_expiration'))
 
@@ -452,12 +560,13 @@ async def process_add_expires_at(message: types.Message, state: FSMContext):
                 return await message.answer(_('add_invalid_future_expiration'))
         expires_str = expires_at.strftime("%d.%m.%Y")
     async with state.proxy() as data:
+        location = state_location(data)
         await bot.send_message(
             message.chat.id,
             md.text(
                 md.text(md.bold(_('add_thanks')), _('details') + ':'),
                 md.text(md.bold(_('type') + ':'), _(data['type']) + ' \\- ' + _(data['kind'])),
-                md.text(md.bold(_('location') + ':'), clean_for_md(str(data['location'].latitude)) + " / " + clean_for_md(str(data['location'].longitude))),
+                md.text(md.bold(_('location') + ':'), clean_for_md(str(location.latitude)) + " / " + clean_for_md(str(location.longitude))),
                 md.text(md.bold(_('expires_at') + ':'), clean_for_md(expires_str)),
                 md.text(md.bold(_('description') + ':')),
                 md.text(clean_for_md(data['description'])),
@@ -466,15 +575,12 @@ async def process_add_expires_at(message: types.Message, state: FSMContext):
             reply_markup=types.ReplyKeyboardRemove(),
             parse_mode='MarkdownV2'#ParseMode.MARKDOWN,
         )
-        await add_db_entry(message.from_user.id, message.from_user.locale.language, data['type'], data['kind'], data['location'], data['description'], expires_at)
-        subscriptions = await search_db_subscriptions(message.from_user.id, data['type'], data['kind'], data['location'])
-        user_ids = []
-        for sub in subscriptions:
-            i18n.set('locale', sub[1])
-            user = str(message.from_user.id)
-            if not user in user_ids:
-                user_ids.append(user)
-                link = f'[{message.from_user.mention}](tg://user?id\={user})'
+        entry_id = await add_db_entry(message.from_user.id, current_locale.get(), data['type'], data['kind'], location, data['description'], expires_at)
+        user = str(message.from_user.id)
+        link = f'[{message.from_user.mention}](tg://user?id\={user})'
+        locations = [(location.latitude, location.longitude)]
+        for sub in await match_new_entry(entry_id, message.from_user.id, data['type'], data['kind'], location, link):
+            with use_locale(sub[1]):
                 msg = md.text(
                         md.text(_('subscription_incoming', link=link)),
                         md.text(md.bold(_('details') + ':')),
@@ -483,19 +589,112 @@ async def process_add_expires_at(message: types.Message, state: FSMContext):
                         md.text(clean_for_md(data['description'])),
                         sep='\n',
                     )
-                await bot.send_message(
-                    sub[0],
-                    msg,
-                    reply_markup=types.ReplyKeyboardRemove(),
-                    parse_mode='MarkdownV2',#ParseMode.MARKDOWN,
-                )
-                await types.ChatActions.upload_photo()
-                map = await render_map([(data['location'].latitude, data['location'].longitude)])
-                await bot.send_photo(sub[0], map, _('map_locations'))
+                caption = _('map_locations')
+            await notifications.submit(sub[0],
+                partial(bot.send_message, sub[0], msg, reply_markup=types.ReplyKeyboardRemove(), parse_mode='MarkdownV2'),
+                partial(send_map, sub[0], locations, caption))
     await state.finish()
 
-if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_db())
+async def send_digest(user_id, user_lang, matches):
+    with use_locale(user_lang):
+        blocks = [md.text(_('digest_incoming', count=str(len(matches))))]
+        for num, (link, entry) in enumerate(matches):
+            blocks.append(md.text(
+                md.text('\\#', md.bold(num + 1)),
+                md.text(md.bold(_('type') + ':'), _(entry[3]) + ' \\- ' + _(entry[4])),
+                md.text(md.bold(_('description') + ':'), clean_for_md(entry[7])),
+                md.text(link),
+                sep='\n',
+            ))
+        caption = _('map_locations')
+    sends = [partial(bot.send_message, user_id, text, parse_mode='MarkdownV2') for text in pack_messages(blocks)]
+    # one map with every entry of the digest
+    sends.append(partial(send_map, user_id, [(entry[5], entry[6]) for _, entry in matches], caption))
+    await notifications.submit(user_id, *sends)
+
+async def flush_digests():
+    for delivery, period in DIGEST_PERIODS.items():
+        digests = {}
+        for user_id, user_lang, link, entry in await take_due_notifications(delivery, period):
+            digests.setdefault((user_id, user_lang), []).append((link, entry))
+        for (user_id, user_lang), matches in digests.items():
+            await send_digest(user_id, user_lang, matches)
+        if digests:
+            logging.info('Sent %d %s digests', len(digests), delivery)
+
+background_tasks = []
+metrics_servers = []
+renderer_warmup = None
+
+async def run_periodically(interval, func):
+    while True:
+        try:
+            await func()
+        except Exception:
+            logging.exception('Periodic job %s failed', func.__name__)
+        await asyncio.sleep(interval)
+
+async def purge_expired():
+    purged = await purge_expired_entries()
+    if purged > 0:
+        logging.info('Purged %d expired entries', purged)
+    if isinstance(storage, SQLiteStorage):
+        abandoned = await storage.purge_expired()
+        if abandoned > 0:
+            logging.info('Purged %d abandoned conversations', abandoned)
+
+async def on_startup(dp):
+    global renderer_warmup
+    if METRICS_PORT:
+        # every webhook worker serves its own metrics on the next port; it
+        # comes up first so /ready answers while the database is opened
+        with phase('metrics server'):
+            metrics_servers.append(await start_metrics_server(int(METRICS_PORT) + int(WORKER_INDEX or 0)))
+    with phase('init_db'):
+        # in webhook mode the front end migrated the database before starting
+        # the workers, so they don't all run the migrations at once
+        await init_db(migrations=WORKER_INDEX is None)
+    notifications.start()
+    if MAP_PREWARM:
+        # maps are drawn by a stack that is only imported on first use
+        renderer_warmup = asyncio.create_task(prewarm_renderer())
+        background_tasks.append(renderer_warmup)
+    if WORKER_INDEX in (None, '0'):
+        background_tasks.append(asyncio.create_task(run_periodically(PURGE_INTERVAL, purge_expired)))
+        background_tasks.append(asyncio.create_task(run_periodically(DIGEST_CHECK_INTERVAL, flush_digests)))
+    if WORKER_INDEX is not None:
+        # other workers add and delete subscriptions and entries too
+        background_tasks.append(asyncio.create_task(run_periodically(SUBSCRIPTION_REFRESH_INTERVAL, refresh_subscription_index)))
+        if SEARCH_ENGINE == 'snapshot':
+            background_tasks.append(asyncio.create_task(run_periodically(SUBSCRIPTION_REFRESH_INTERVAL, refresh_entry_snapshot)))
+    set_ready()
+
+async def on_shutdown(dp):
+    set_ready(False)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await notifications.stop()
+    for runner in metrics_servers:
+        await runner.cleanup()
+    shutdown_renderer()
+    await close_db()
+
+async def profile_startup():
+    # runs the startup steps without polling and reports where the time goes
+    await on_startup(dp)
+    if renderer_warmup is not None:
+        await renderer_warmup
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    session = await bot.get_session()
+    await session.close()
+    report('teilwas_bot')
 
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+if __name__ == '__main__':
+    if '--profile-startup' in sys.argv:
+        asyncio.run(profile_startup())
+    else:
+        skip_updates = os.environ.get('TW_SKIP_UPDATES', '0') == '1'
+        executor.start_polling(dp, skip_updates=skip_updates, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
@@ -1,108 +1,626 @@
+import os
+import re
+import logging
+import time
+import json
+import heapq
+import asyncio
 import aiosqlite
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from datetime import datetime
 
+from tw_geo import bounding_box
+from tw_subscriptions import SubscriptionIndex
+from tw_shards import ShardMap, CELL_DEGREES, id_base
+from tw_metrics import Histogram, timed
+from tw_startup import phase
+
 DB = 'db.sqlite'
+DB_POOL_SIZE = int(os.environ.get('TW_DB_POOL_SIZE', '4'))
+DB_STATEMENT_CACHE = int(os.environ.get('TW_DB_STATEMENT_CACHE', '256'))
+PURGE_INTERVAL = int(os.environ.get('TW_PURGE_INTERVAL', '3600'))
+PURGE_BATCH_SIZE = int(os.environ.get('TW_PURGE_BATCH_SIZE', '500'))
+VACUUM_PAGES = int(os.environ.get('TW_VACUUM_PAGES', '2000'))
+# how long a process waits for another one that is migrating the same file
+MIGRATION_TIMEOUT = int(os.environ.get('TW_MIGRATION_TIMEOUT', '600'))
+# 'snapshot' answers searches without keywords from an in-memory copy of the
+# live entries, see tw_snapshot
+SEARCH_ENGINE = os.environ.get('TW_SEARCH_ENGINE', 'sql')
+
+DELIVERY_MODES = ['instant', 'hourly', 'daily']
+# a digest is sent once the oldest pending match of a subscriber is this old
+DIGEST_PERIODS = {'hourly': 3600, 'daily': 24 * 3600}
+
+DB_SECONDS = Histogram('tw_db_seconds', 'Duration of tw_db calls', ['function'])
+
+def instrumented(func):
+    return timed(DB_SECONDS, function=func.__name__)(func)
+
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL;',
+    'PRAGMA synchronous = NORMAL;',
+    'PRAGMA temp_store = MEMORY;',
+    'PRAGMA cache_size = -16000;',
+    'PRAGMA mmap_size = 268435456;',
+    'PRAGMA busy_timeout = 5000;',
+]
+
+async def prepare_connection(db):
+    await db.enable_load_extension(True)
+    await db.load_extension('mod_spatialite')
+    for pragma in PRAGMAS:
+        # closing the cursor releases the read lock a pragma's result holds,
+        # which would block the next connection switching a new file to WAL
+        async with db.execute(pragma):
+            pass
+
+class ConnectionPool:
+    # every aiosqlite connection owns a thread, so they are opened once at
+    # startup with SpatiaLite already loaded and then shared by all queries
+    def __init__(self, path, size):
+        self._path = path
+        self._size = size
+        self._queue = None
+        self._connections = []
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_open(self):
+        return self._queue is not None
+
+    async def open(self):
+        async with self._lock:
+            if self.is_open:
+                return
+            queue = asyncio.Queue()
+            for _ in range(self._size):
+                db = await aiosqlite.connect(self._path, cached_statements=DB_STATEMENT_CACHE)
+                await prepare_connection(db)
+                self._connections.append(db)
+                queue.put_nowait(db)
+            self._queue = queue
+
+    async def close(self):
+        async with self._lock:
+            if not self.is_open:
+                return
+            for db in self._connections:
+                await db.close()
+            self._connections = []
+            self._queue = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.is_open:
+            await self.open()
+        db = await self._queue.get()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+            self._queue.put_nowait(db)
+
+# one pool per shard, shard 0 is DB; see tw_shards for the layout
+shard_map = ShardMap()
+pools = {0: ConnectionPool(DB, DB_POOL_SIZE)}
+pool_size = DB_POOL_SIZE
+
+def use_db(path, size=DB_POOL_SIZE):
+    global DB, shard_map, pools, pool_size, entry_snapshot
+    DB = path
+    shard_map = ShardMap()
+    pools = {0: ConnectionPool(path, size)}
+    pool_size = size
+    if entry_snapshot is not None:
+        entry_snapshot = type(entry_snapshot)()
+
+def shard_path(shard):
+    # shard files are given relative to the main database
+    if shard == 0:
+        return DB
+    return os.path.join(os.path.dirname(DB), shard_map.path(shard))
+
+def connection(shard=0):
+    return pools[shard].acquire()
+
+subscription_index = SubscriptionIndex()
+entry_snapshot = None
+if SEARCH_ENGINE == 'snapshot':
+    # numpy is only imported by bots searching the snapshot
+    from tw_snapshot import EntrySnapshot
+    entry_snapshot = EntrySnapshot()
+
+# every statement below is built from a fixed set of templates with bound
+# parameters, so sqlite3's per-connection statement cache is reused across
+# requests instead of re-parsing one unique SQL text per call
+POINT = 'MakePoint(?, ?, 4326)'
+
+# candidates are pruned through the R*Tree that CreateSpatialIndex() maintains
+# for geteilt.latlng before the geodesic distance is evaluated
+SPATIAL_INDEX_FILTER = """ AND geteilt.id IN (SELECT pkid FROM idx_geteilt_latlng
+    WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?)"""
+
+# descriptions are indexed by geteilt_fts; keywords only ever reach MATCH as
+# quoted prefix terms, so user input can't use the FTS5 query syntax
+MAX_KEYWORDS = 8
+
+def match_query(keywords):
+    terms = re.findall(r'\w+', keywords or '')[:MAX_KEYWORDS]
+    if not terms:
+        return None
+    return ' '.join('"' + term + '"*' for term in terms)
+
+KEYWORD_FILTER = " AND geteilt.id IN (SELECT rowid FROM geteilt_fts WHERE geteilt_fts MATCH ?)"
+
+def entry_filter(filter_type, filter_kind, filter_location, filter_keywords=False):
+    query = "expires_at > ? AND user_id <> ?"
+    if filter_type:
+        query += " AND type = ?"
+    if filter_kind:
+        query += " AND kind = ?"
+    if filter_location:
+        query += SPATIAL_INDEX_FILTER
+        query += f" AND PtDistWithin(geteilt.latlng, {POINT}, ?) = TRUE"
+    if filter_keywords:
+        query += KEYWORD_FILTER
+    return query
 
-async def search_db_entry(user_id, type, kind, location, distance):
-    curdate = str(datetime.now().strftime('%Y%m%d'))
-    query = f"SELECT * FROM geteilt where expires_at > {curdate}"
-    query += f" AND user_id <> {user_id}"
+@lru_cache(maxsize=None)
+def entry_search_query(filter_type, filter_kind, filter_location, filter_keywords=False):
+    return f"SELECT * FROM geteilt WHERE {entry_filter(filter_type, filter_kind, filter_location, filter_keywords)};"
+
+# the columns show_results needs, in the same positions as SELECT *, with the
+# description cut to a preview and the distance in meters appended
+DESC_PREVIEW = 200
+LIST_COLUMNS = ', '.join('geteilt.' + column for column in ['id', 'user_id', 'user_lang', 'type', 'kind', 'lat', 'lng']) + \
+    f", substr(geteilt.desc, 1, {DESC_PREVIEW}), geteilt.inserted_at, geteilt.expires_at"
+
+@lru_cache(maxsize=None)
+def entry_page_query(filter_type, filter_kind, filter_location, after, filter_keywords=False):
+    where = entry_filter(filter_type, filter_kind, filter_location)
+    if filter_keywords:
+        # best bm25 match first (lower is better), keyset on (rank, id); the
+        # distance is still returned for display
+        dist = f"ST_Distance(geteilt.latlng, {POINT}, 1)" if filter_location else "NULL"
+        query = f"""SELECT * FROM (SELECT {LIST_COLUMNS}, {dist} AS dist, bm25(geteilt_fts) AS rank
+            FROM geteilt_fts JOIN geteilt ON geteilt.id = geteilt_fts.rowid
+            WHERE geteilt_fts MATCH ? AND {where})"""
+        if after:
+            query += " WHERE rank > ? OR (rank = ? AND id > ?)"
+        return query + " ORDER BY rank, id LIMIT ?;"
+    if filter_location:
+        # nearest first, keyset on (distance, id)
+        query = f"""SELECT * FROM (SELECT {LIST_COLUMNS}, ST_Distance(latlng, {POINT}, 1) AS dist
+            FROM geteilt WHERE {where})"""
+        if after:
+            query += " WHERE dist > ? OR (dist = ? AND id > ?)"
+        return query + " ORDER BY dist, id LIMIT ?;"
+    # newest first, keyset on (inserted_at, id). The ids of a shard start at
+    # its id base, so they only order the entries of one day within a shard
+    query = f"SELECT {LIST_COLUMNS}, NULL AS dist FROM geteilt WHERE {where}"
+    if after:
+        query += " AND (inserted_at < ? OR (inserted_at = ? AND id < ?))"
+    return query + " ORDER BY inserted_at DESC, id DESC LIMIT ?;"
+
+def entry_search_params(user_id, type, kind, location, distance):
+    params = [datetime.now().strftime('%Y%m%d'), user_id]
     if type != 'all':
-        query += f" AND type = '{type}'"
+        params.append(type)
     if kind != 'all':
-        query += f" AND kind = '{kind}'"
+        params.append(kind)
+    if location is not None:
+        meters = int(distance) * 1000
+        min_lng, min_lat, max_lng, max_lat = bounding_box(location.latitude, location.longitude, meters)
+        params += [max_lng, min_lng, max_lat, min_lat]
+        params += [location.longitude, location.latitude, meters]
+    return params
+
+async def fetch_all(query, params, shard=0):
+    async with connection(shard) as db:
+        async with db.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+async def fetch_shards(query, params, shards):
+    # runs the query on every given shard concurrently, one result list each
+    if len(shards) == 1:
+        return [await fetch_all(query, params, shards[0])]
+    return await asyncio.gather(*[fetch_all(query, params, shard) for shard in shards])
+
+def entry_shards(location, distance):
+    # the shards a search has to ask: all of them for "everywhere", otherwise
+    # the ones owning a cell within the search radius
+    if location is None:
+        return shard_map.all()
+    return shard_map.for_box(*bounding_box(location.latitude, location.longitude, int(distance) * 1000))
+
+# the snapshot's copy of the live entries, in list columns
+SNAPSHOT_QUERY = f"SELECT {LIST_COLUMNS} FROM geteilt WHERE expires_at > ?;"
+snapshot_lock = asyncio.Lock()
+
+async def read_entry_snapshot():
+    # with snapshot_lock held
+    today = datetime.now().strftime('%Y%m%d')
+    entry_snapshot.start_load()
+    try:
+        results = await fetch_shards(SNAPSHOT_QUERY, (today,), shard_map.all())
+    except BaseException:
+        entry_snapshot.abort_load()
+        raise
+    entry_snapshot.load([row for rows in results for row in rows], int(today))
+
+async def load_entry_snapshot():
+    async with snapshot_lock:
+        await read_entry_snapshot()
+
+def snapshot_outdated():
+    # rebuilt once a day, which also drops the rows that expired since
+    return entry_snapshot.stale or entry_snapshot.day != int(datetime.now().strftime('%Y%m%d'))
 
+async def current_snapshot():
+    if snapshot_outdated():
+        async with snapshot_lock:
+            # searches that queued up behind a reload find it done
+            if snapshot_outdated():
+                await read_entry_snapshot()
+    return entry_snapshot
+
+def snapshot_args(user_id, type, kind, location, distance):
+    if location is None:
+        return user_id, type, kind, None, None, None, int(datetime.now().strftime('%Y%m%d'))
+    return (user_id, type, kind, location.latitude, location.longitude, int(distance) * 1000,
+        int(datetime.now().strftime('%Y%m%d')))
+
+ENTRY_ROWS_BY_ID_QUERY = "SELECT * FROM geteilt WHERE id IN (SELECT value FROM json_each(?));"
+
+@instrumented
+async def search_db_entry(user_id, type, kind, location, distance, keywords=None):
+    match = match_query(keywords)
+    if entry_snapshot is not None and match is None:
+        # the snapshot finds the ids, the full rows come from their shards
+        snapshot = await current_snapshot()
+        ids = snapshot.ids(*snapshot_args(user_id, type, kind, location, distance))
+        shards = {}
+        for entry_id in ids:
+            shards.setdefault(shard_map.for_id(entry_id), []).append(entry_id)
+        results = [await fetch_all(ENTRY_ROWS_BY_ID_QUERY, (json.dumps(shard_ids),), shard) for shard, shard_ids in shards.items()]
+        return [row for rows in results for row in rows]
+    query = entry_search_query(type != 'all', kind != 'all', location is not None, match is not None)
+    params = entry_search_params(user_id, type, kind, location, distance)
+    if match is not None:
+        params.append(match)
+    results = await fetch_shards(query, params, entry_shards(location, distance))
+    return [row for rows in results for row in rows]
+
+@instrumented
+async def search_db_entry_page(user_id, type, kind, location, distance, after=None, limit=10, keywords=None):
+    # returns one page of list rows and the cursor for the next page, which is
+    # None once everything was returned
+    match = match_query(keywords)
+    if entry_snapshot is not None and match is None:
+        snapshot = await current_snapshot()
+        rows = snapshot.page(*snapshot_args(user_id, type, kind, location, distance), after, limit)
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, page_cursor(rows[-1], False, location is not None)
+    query = entry_page_query(type != 'all', kind != 'all', location is not None, after is not None, match is not None)
+    params = entry_search_params(user_id, type, kind, location, distance)
+    if match is not None:
+        params = [match] + params
     if location is not None:
-        dist = int(distance) * 1000
-        query += f" AND (PtDistWithin(geteilt.latlng, PointFromText('POINT({location.longitude} {location.latitude})', 4326), {dist})=TRUE)"
-        
-    query += ";"
-    res = []
-    async with aiosqlite.connect(DB) as db:
-        await db.enable_load_extension(True)
-        await db.load_extension('mod_spatialite')
-        async with db.execute(query) as cursor:
-            async for row in cursor:
-                res.append(row)
-    return res
+        params = [location.longitude, location.latitude] + params
+    if after is not None:
+        params += [after[0], after[0], after[1]]
+    params.append(limit + 1)
+    # every shard returns its first limit + 1 rows in page order, merged here;
+    # bm25 ranks come from per-shard statistics, close enough to interleave
+    if match is not None:
+        key = lambda row: (row[11], row[0])
+    elif location is not None:
+        key = lambda row: (row[10], row[0])
+    else:
+        key = lambda row: (row[8], row[0])
+    results = await fetch_shards(query, params, entry_shards(location, distance))
+    rows = list(heapq.merge(*results, key=key, reverse=match is None and location is None))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, page_cursor(rows[-1], match is not None, location is not None)
+
+def page_cursor(row, keywords, location):
+    # keyset on the rank for keyword searches, on the distance for nearby
+    # ones and on the insertion day otherwise
+    if keywords:
+        return [row[11], row[0]]
+    if location:
+        return [row[10], row[0]]
+    return [row[8], row[0]]
+
+@instrumented
+async def get_db_entry(entry_uid):
+    shard = shard_map.for_id(entry_uid)
+    if shard is None:
+        return None
+    rows = await fetch_all("SELECT * FROM geteilt WHERE id = ?;", (entry_uid,), shard)
+    return rows[0] if rows else None
 
+@instrumented
 async def delete_db_entry(entry_uid):
-    async with aiosqlite.connect(DB) as db:
-        await db.execute(f"DELETE FROM geteilt WHERE id = {entry_uid};")
+    shard = shard_map.for_id(entry_uid)
+    if shard is None:
+        return
+    async with connection(shard) as db:
+        await db.execute("DELETE FROM geteilt WHERE id = ?;", (entry_uid,))
         await db.commit()
+    if entry_snapshot is not None:
+        entry_snapshot.remove(entry_uid)
 
+def merge_oldest_first(results):
+    # rows of geteilt or subscriptions, both have inserted_at in column 8
+    return list(heapq.merge(*results, key=lambda row: (row[8], row[0])))
+
+@instrumented
 async def search_db_own_entry(user_id):
-    query = f"SELECT * FROM geteilt WHERE user_id = {user_id};"
-    res = []
-    async with aiosqlite.connect(DB) as db:
-        async with db.execute(query) as cursor:
-            async for row in cursor:
-                res.append(row)
-    return res
+    return merge_oldest_first(await fetch_shards("SELECT * FROM geteilt WHERE user_id = ? ORDER BY inserted_at, id;", (user_id,),
+        shard_map.all()))
+
+ENTRY_INSERT = f"""INSERT INTO geteilt(user_id, user_lang, type, kind, lat, lng, desc, inserted_at, expires_at, latlng)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {POINT});"""
+
+def entry_insert_params(row):
+    # row in column order, lat and lng repeated for the geometry
+    return tuple(row) + (row[5], row[4])
 
+@instrumented
 async def add_db_entry(user_id, user_lang, type, kind, location, description, expires_at):
     currentDateTime = datetime.now().strftime('%Y%m%d')
-    async with aiosqlite.connect(DB) as db:
-        await db.enable_load_extension(True)
-        await db.execute("SELECT load_extension('mod_spatialite');")
-        last_row = None
-        async with db.execute("INSERT INTO geteilt(user_id, user_lang, type, kind, lat, lng, desc, inserted_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", 
-                (user_id, user_lang, type, kind, location.latitude, location.longitude, 
-                description, currentDateTime, str(expires_at.strftime('%Y%m%d')))) as cursor:
-            last_row = cursor.lastrowid
-        await db.execute(f"UPDATE geteilt SET latlng = PointFromText('POINT({location.longitude} {location.latitude})', 4326) WHERE id = {last_row};")
+    row = (user_id, user_lang, type, kind, location.latitude, location.longitude,
+        description, currentDateTime, str(expires_at.strftime('%Y%m%d')))
+    async with connection(shard_map.for_point(location.latitude, location.longitude)) as db:
+        async with db.execute(ENTRY_INSERT, entry_insert_params(row)) as cursor:
+            entry_id = cursor.lastrowid
         await db.commit()
+    if entry_snapshot is not None:
+        entry_snapshot.add((entry_id,) + row[:6] + (description[:DESC_PREVIEW],) + row[7:])
+    return entry_id
+
+def group_by_shard(rows, lat_col):
+    # rows without a location belong to shard 0
+    shards = {}
+    for row in rows:
+        shard = 0 if row[lat_col] is None else shard_map.for_point(row[lat_col], row[lat_col + 1])
+        shards.setdefault(shard, []).append(row)
+    return shards
 
-async def add_db_subscription(user_id, user_lang, type, kind, location, distance):
+@instrumented
+async def import_db_entries(rows):
+    # bulk insert of (user_id, user_lang, type, kind, lat, lng, desc,
+    # inserted_at, expires_at) rows in a single transaction per shard
+    count = 0
+    for shard, shard_rows in group_by_shard(rows, 4).items():
+        async with connection(shard) as db:
+            async with db.executemany(ENTRY_INSERT, [entry_insert_params(row) for row in shard_rows]) as cursor:
+                count += cursor.rowcount
+            await db.commit()
+    if entry_snapshot is not None:
+        entry_snapshot.stale = True
+    return count
+
+SUBSCRIPTION_INSERT = f"""INSERT INTO subscriptions(id, user_id, user_lang, type, kind, lat, lng, distance, inserted_at, delivery, latlng)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {POINT});"""
+SUBSCRIPTION_EVERYWHERE_INSERT = """INSERT INTO subscriptions(id, user_id, user_lang, type, kind, lat, lng, distance, inserted_at, delivery)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+
+@instrumented
+async def add_db_subscription(user_id, user_lang, type, kind, location, distance, delivery='instant'):
     currentDateTime = datetime.now().strftime('%Y%m%d')
-    async with aiosqlite.connect(DB) as db:
-        await db.enable_load_extension(True)
-        await db.execute("SELECT load_extension('mod_spatialite');")
-        lat = None
-        lng = None
-        if location is not None:
-            lat = location.latitude
-            lng = location.longitude
+    lat = None
+    lng = None
+    shard = 0
+    if location is not None:
+        lat = location.latitude
+        lng = location.longitude
+        shard = shard_map.for_point(lat, lng)
+    async with connection(shard) as db:
         last_row = None
         if distance == 'search_everywhere':
             distance = None
         else: 
             distance = int(distance) * 1000
-        async with db.execute("INSERT INTO subscriptions(user_id, user_lang, type, kind, lat, lng, distance, inserted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", 
-                (user_id, user_lang, type, kind, lat, lng, distance, currentDateTime)) as cursor:
-            last_row = cursor.lastrowid
+        row = (None, user_id, user_lang, type, kind, lat, lng, distance, currentDateTime, delivery)
         if location is not None:
-            await db.execute(f"UPDATE subscriptions SET latlng = PointFromText('POINT({location.longitude} {location.latitude})', 4326) WHERE id = {last_row};")
+            async with db.execute(SUBSCRIPTION_INSERT, row + (lng, lat)) as cursor:
+                last_row = cursor.lastrowid
+            await add_subscription_box(db, last_row, lat, lng, distance)
+        else:
+            async with db.execute(SUBSCRIPTION_EVERYWHERE_INSERT, row) as cursor:
+                last_row = cursor.lastrowid
         await db.commit()
+    subscription_index.add((last_row, user_id, user_lang, type, kind, lat, lng, distance, delivery))
+
+@instrumented
+async def import_db_subscriptions(rows):
+    # bulk insert of (user_id, user_lang, type, kind, lat, lng, distance,
+    # inserted_at, delivery) rows in a single transaction per shard; distance is in meters and
+    # None together with lat and lng for "everywhere". The ids are assigned
+    # here so that the R*Tree boxes can be written in the same transaction.
+    count = 0
+    for shard, shard_rows in group_by_shard(rows, 4).items():
+        async with connection(shard) as db:
+            await db.execute("BEGIN IMMEDIATE;")
+            async with db.execute("""SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'subscriptions'), 0),
+                    coalesce((SELECT max(id) FROM subscriptions), 0));""") as cursor:
+                first = (await cursor.fetchone())[0] + 1
+            shard_rows = [(first + i,) + tuple(row) for i, row in enumerate(shard_rows)]
+            located = [row for row in shard_rows if row[5] is not None]
+            await db.executemany(SUBSCRIPTION_INSERT, [row + (row[6], row[5]) for row in located])
+            await db.executemany(SUBSCRIPTION_EVERYWHERE_INSERT, [row for row in shard_rows if row[5] is None])
+            boxes = []
+            for row in located:
+                min_lng, min_lat, max_lng, max_lat = bounding_box(row[5], row[6], row[7])
+                boxes.append((row[0], min_lng, max_lng, min_lat, max_lat))
+            await db.executemany("INSERT INTO subscriptions_rtree(id, min_lng, max_lng, min_lat, max_lat) VALUES (?, ?, ?, ?, ?);", boxes)
+            await db.commit()
+        for row in shard_rows:
+            subscription_index.add(row[:8] + row[9:10])
+        count += len(shard_rows)
+    return count
+
+async def add_subscription_box(db, subscription_id, lat, lng, distance):
+    min_lng, min_lat, max_lng, max_lat = bounding_box(lat, lng, distance)
+    await db.execute("INSERT OR REPLACE INTO subscriptions_rtree(id, min_lng, max_lng, min_lat, max_lat) VALUES (?, ?, ?, ?, ?);",
+        (subscription_id, min_lng, max_lng, min_lat, max_lat))
 
+@instrumented
 async def delete_db_subscription(entry_uid):
-    async with aiosqlite.connect(DB) as db:
-        await db.execute(f"DELETE FROM subscriptions WHERE id = {entry_uid};")
-        await db.commit()
+    shard = shard_map.for_id(entry_uid)
+    if shard is not None:
+        async with connection(shard) as db:
+            await db.execute("DELETE FROM subscriptions WHERE id = ?;", (entry_uid,))
+            await db.execute("DELETE FROM subscriptions_rtree WHERE id = ?;", (entry_uid,))
+            await db.commit()
+    subscription_index.remove(entry_uid)
+
+# each subscription has its own radius, so the geometry index on
+# subscriptions.latlng can't answer "who covers this point". Instead every
+# located subscription keeps its radius as a box in subscriptions_rtree and is
+# found with a point-in-box lookup; "everywhere" subscriptions are their own
+# bucket served by a partial index.
+SUBSCRIPTION_SEARCH_QUERY = f"""SELECT user_id, user_lang, distance, delivery FROM subscriptions
+    WHERE latlng IS NULL AND type IN (?, 'all') AND kind IN (?, 'all') AND user_id <> ?
+    UNION ALL
+    SELECT s.user_id, s.user_lang, s.distance, s.delivery FROM subscriptions_rtree r
+    JOIN subscriptions s ON s.id = r.id
+    WHERE r.min_lng <= ? AND r.max_lng >= ? AND r.min_lat <= ? AND r.max_lat >= ?
+        AND s.type IN (?, 'all') AND s.kind IN (?, 'all') AND s.user_id <> ?
+        AND PtDistWithin(s.latlng, {POINT}, s.distance) = TRUE;"""
+
+@instrumented
+async def query_db_subscriptions(user_id, type, kind, location):
+    # a subscription is stored in the shard of its center but its radius may
+    # reach into any other, so all shards are asked
+    lng = location.longitude
+    lat = location.latitude
+    results = await fetch_shards(SUBSCRIPTION_SEARCH_QUERY, (type, kind, user_id, lng, lng, lat, lat, type, kind, user_id, lng, lat),
+        shard_map.all())
+    return [row for rows in results for row in rows]
 
+@instrumented
 async def search_db_subscriptions(user_id, type, kind, location):
-    query = f"""SELECT user_id, user_lang, distance FROM subscriptions WHERE 
-        user_id <> {user_id}
-        AND (type = '{type}' OR type = 'all') AND (kind = '{kind}' or kind = 'all')
-        AND (subscriptions.latlng is NULL OR 
-            (PtDistWithin(subscriptions.latlng, PointFromText('POINT({location.longitude} {location.latitude})', 4326), subscriptions.distance)=TRUE))"""
-    res = []
-    async with aiosqlite.connect(DB) as db:
-        await db.enable_load_extension(True)
-        await db.load_extension('mod_spatialite')
-        async with db.execute(query) as cursor:
-            async for row in cursor:
-                res.append(row)
-    return res
+    return subscription_index.match(user_id, type, kind, location.latitude, location.longitude)
+
+SUBSCRIPTION_INDEX_QUERY = "SELECT id, user_id, user_lang, type, kind, lat, lng, distance, delivery FROM subscriptions;"
+
+async def fetch_subscription_rows():
+    results = await fetch_shards(SUBSCRIPTION_INDEX_QUERY, (), shard_map.all())
+    return [row for rows in results for row in rows]
 
+@instrumented
+async def load_subscription_index():
+    subscription_index.load(await fetch_subscription_rows())
+
+subscription_table_version = None
+
+@instrumented
+async def refresh_subscription_index():
+    # reloads the index when another process changed one of the tables. A
+    # process only updates its own index when it writes, so with several
+    # webhook workers a subscription added or deleted through one worker is
+    # matched differently by the others until their next refresh
+    # (TW_SUBSCRIPTION_REFRESH_INTERVAL, 30 s by default)
+    global subscription_table_version
+    version = tuple(tuple(rows) for rows in await fetch_shards("SELECT max(id), count(*) FROM subscriptions;", (), shard_map.all()))
+    if version != subscription_table_version:
+        await load_subscription_index()
+        subscription_table_version = version
+
+entry_table_version = None
+
+@instrumented
+async def refresh_entry_snapshot():
+    # reloads the snapshot when another process changed one of the tables
+    global entry_table_version
+    version = tuple(tuple(rows) for rows in await fetch_shards("SELECT max(id), count(*) FROM geteilt;", (), shard_map.all()))
+    if version != entry_table_version:
+        await load_entry_snapshot()
+        entry_table_version = version
+
+async def check_subscription_index():
+    # ids where the index and the tables disagree, see bench/run.py
+    missing, stale, unknown = subscription_index.diff(await fetch_subscription_rows())
+    return {'missing': missing, 'stale': stale, 'unknown': unknown}
+
+@instrumented
 async def search_db_own_subscriptions(user_id):
-    query = f"SELECT * FROM subscriptions WHERE user_id = {user_id};"
-    res = []
-    async with aiosqlite.connect(DB) as db:
-        async with db.execute(query) as cursor:
-            async for row in cursor:
-                res.append(row)
-    return res
+    return merge_oldest_first(await fetch_shards("SELECT * FROM subscriptions WHERE user_id = ? ORDER BY inserted_at, id;", (user_id,),
+        shard_map.all()))
+
+# matches of hourly and daily subscriptions wait here for the next digest;
+# a subscriber is notified of an entry only once however many of their
+# subscriptions match it
+@instrumented
+async def add_pending_notifications(rows):
+    # rows of (user_id, user_lang, delivery, entry_id, link)
+    now = int(time.time())
+    async with connection() as db:
+        await db.executemany("""INSERT OR IGNORE INTO pending_notifications(user_id, user_lang, delivery, entry_id, link, created_at)
+            VALUES (?, ?, ?, ?, ?, ?);""", [tuple(row) + (now,) for row in rows])
+        await db.commit()
+
+@instrumented
+async def match_new_entry(entry_id, user_id, type, kind, location, link):
+    # one notification per subscriber, as soon as any of their matching
+    # subscriptions asks for it: hourly and daily ones are queued for the
+    # digest, the instant ones are returned as (user_id, user_lang, distance,
+    # delivery) for the caller to send
+    subscribers = {}
+    for sub in await search_db_subscriptions(user_id, type, kind, location):
+        if sub[0] not in subscribers or DELIVERY_MODES.index(sub[3]) < DELIVERY_MODES.index(subscribers[sub[0]][3]):
+            subscribers[sub[0]] = sub
+    pending = [(sub[0], sub[1], sub[3], entry_id, link) for sub in subscribers.values() if sub[3] != 'instant']
+    if pending:
+        await add_pending_notifications(pending)
+    return [sub for sub in subscribers.values() if sub[3] == 'instant']
+
+DUE_DIGESTS = """user_id IN (SELECT user_id FROM pending_notifications WHERE delivery = ?
+    GROUP BY user_id HAVING min(created_at) <= ?)"""
+
+# the ids are passed as one JSON array so the statement text stays the same
+ENTRIES_BY_ID_QUERY = f"""SELECT {LIST_COLUMNS} FROM geteilt
+    WHERE expires_at > ? AND id IN (SELECT value FROM json_each(?));"""
+
+async def fetch_entries(entry_ids):
+    # unexpired entries by id in list columns, looked up in their shards
+    shards = {}
+    for entry_id in entry_ids:
+        shard = shard_map.for_id(entry_id)
+        if shard is not None:
+            shards.setdefault(shard, []).append(entry_id)
+    curdate = datetime.now().strftime('%Y%m%d')
+    entries = {}
+    for shard, ids in shards.items():
+        for row in await fetch_all(ENTRIES_BY_ID_QUERY, (curdate, json.dumps(ids)), shard):
+            entries[row[0]] = row
+    return entries
+
+@instrumented
+async def take_due_notifications(delivery, period):
+    # removes and returns the pending matches of every subscriber whose
+    # oldest one waited for period seconds, as (user_id, user_lang, link,
+    # entry) with the entry in list columns, grouped by subscriber; entries
+    # deleted or expired in the meantime are dropped
+    params = (delivery, int(time.time()) - period)
+    async with connection() as db:
+        await db.execute("BEGIN IMMEDIATE;")
+        async with db.execute(f"""SELECT user_id, user_lang, link, entry_id FROM pending_notifications
+                WHERE delivery = ? AND {DUE_DIGESTS} ORDER BY user_id, id;""", (delivery,) + params) as cursor:
+            rows = await cursor.fetchall()
+        await db.execute(f"DELETE FROM pending_notifications WHERE delivery = ? AND {DUE_DIGESTS};", (delivery,) + params)
+        await db.commit()
+    entries = await fetch_entries([row[3] for row in rows])
+    return [(row[0], row[1], row[2], entries[row[3]]) for row in rows if row[3] in entries]
 
 async def check_point_col_exists(db):
     point_col_exists = False
@@ -111,39 +629,285 @@ async def check_point_col_exists(db):
             point_col_exists = 'POINT' in row[0]
     return point_col_exists
 
-async def init_db():
-    async with aiosqlite.connect(DB) as db:
-        point_col_exists = await check_point_col_exists(db)
-        if not point_col_exists:
-            await db.enable_load_extension(True)
-            await db.execute("SELECT load_extension('mod_spatialite');")
-            await db.execute("SELECT InitSpatialMetaData();")
-            await db.execute("""CREATE TABLE IF NOT EXISTS geteilt (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_lang VARCHAR(2),
-                type VARCHAR(10),
-                kind VARCHAR(10),
-                lat FLOAT,
-                lng FLOAT,
-                desc TEXT,
-                inserted_at TEXT,
-                expires_at TEXT
-                );""")
-            await db.execute("SELECT AddGeometryColumn('geteilt', 'latlng', 4326, 'POINT', 'XY');")
-            await db.execute("SELECT CreateSpatialIndex('geteilt', 'latlng');")
-
-            await db.execute("""CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_lang VARCHAR(2),
-                type VARCHAR(10),
-                kind VARCHAR(10),
-                lat FLOAT,
-                lng FLOAT,
-                distance INTEGER,
-                inserted_at TEXT
-                );""")
-            await db.execute("SELECT AddGeometryColumn('subscriptions', 'latlng', 4326, 'POINT', 'XY');")
-            await db.execute("SELECT CreateSpatialIndex('subscriptions', 'latlng');")
-            await db.commit()
\ No newline at end of file
+@instrumented
+async def purge_expired_entries(batch_size=PURGE_BATCH_SIZE):
+    # deletes everything search_db_entry already hides from the shards this
+    # node owns, in small transactions so concurrent writers aren't locked
+    # out; SpatiaLite's triggers remove the rows from idx_geteilt_latlng as well
+    curdate = datetime.now().strftime('%Y%m%d')
+    total = 0
+    for shard in shard_map.owned():
+        purged = 0
+        while True:
+            async with connection(shard) as db:
+                async with db.execute("DELETE FROM geteilt WHERE id IN (SELECT id FROM geteilt WHERE expires_at <= ? LIMIT ?);",
+                        (curdate, batch_size)) as cursor:
+                    deleted = cursor.rowcount
+                await db.commit()
+            purged += deleted
+            if deleted < batch_size:
+                break
+            await asyncio.sleep(0)
+        if purged > 0:
+            async with connection(shard) as db:
+                # sqlite3's execute() steps a pragma only once, which frees a
+                # single page; executescript() runs it to completion
+                await db.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+        total += purged
+    if entry_snapshot is not None and total > 0:
+        # drops the purged rows from the arrays, not just from the results
+        await load_entry_snapshot()
+    return total
+
+# full text index over the descriptions, kept in sync with geteilt by triggers
+# so add_db_entry, delete_db_entry and the purge need no extra statements
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS geteilt_fts USING fts5(desc, content='geteilt', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3');""",
+    """CREATE TRIGGER IF NOT EXISTS geteilt_fts_insert AFTER INSERT ON geteilt BEGIN
+        INSERT INTO geteilt_fts(rowid, desc) VALUES (new.id, new.desc);
+        END;""",
+    """CREATE TRIGGER IF NOT EXISTS geteilt_fts_delete AFTER DELETE ON geteilt BEGIN
+        INSERT INTO geteilt_fts(geteilt_fts, rowid, desc) VALUES ('delete', old.id, old.desc);
+        END;""",
+    """CREATE TRIGGER IF NOT EXISTS geteilt_fts_update AFTER UPDATE OF desc ON geteilt BEGIN
+        INSERT INTO geteilt_fts(geteilt_fts, rowid, desc) VALUES ('delete', old.id, old.desc);
+        INSERT INTO geteilt_fts(rowid, desc) VALUES (new.id, new.desc);
+        END;""",
+]
+
+async def upgrade_fts(db):
+    async with db.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'geteilt_fts';") as cursor:
+        exists = (await cursor.fetchone())[0] > 0
+    for statement in FTS_SCHEMA:
+        await db.execute(statement)
+    if not exists:
+        # index the entries that were there before
+        await db.execute("INSERT INTO geteilt_fts(geteilt_fts) VALUES ('rebuild');")
+
+async def upgrade_delivery(db):
+    async with db.execute("PRAGMA table_info(subscriptions);") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if 'delivery' not in columns:
+        try:
+            await db.execute("ALTER TABLE subscriptions ADD COLUMN delivery TEXT NOT NULL DEFAULT 'instant';")
+        except aiosqlite.OperationalError as e:
+            # added by a run that didn't record its version
+            if 'duplicate column' not in str(e):
+                raise
+    await db.execute("""CREATE TABLE IF NOT EXISTS pending_notifications (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        user_lang VARCHAR(2),
+        delivery VARCHAR(10),
+        entry_id INTEGER,
+        link TEXT,
+        created_at INTEGER,
+        UNIQUE (user_id, entry_id)
+        );""")
+    await db.execute("CREATE INDEX IF NOT EXISTS pending_notifications_delivery ON pending_notifications(delivery, user_id, created_at);")
+
+async def create_tables(db):
+    if await check_point_col_exists(db):
+        return
+    # inside migrate()'s transaction, so the SpatiaLite metadata is written in
+    # one go; InitSpatialMetaData(1) would try to open a transaction of its own
+    await db.execute("SELECT InitSpatialMetaData();")
+    await db.execute("""CREATE TABLE IF NOT EXISTS geteilt (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        user_lang VARCHAR(2),
+        type VARCHAR(10),
+        kind VARCHAR(10),
+        lat FLOAT,
+        lng FLOAT,
+        desc TEXT,
+        inserted_at TEXT,
+        expires_at TEXT
+        );""")
+    await db.execute("SELECT AddGeometryColumn('geteilt', 'latlng', 4326, 'POINT', 'XY');")
+    await db.execute("SELECT CreateSpatialIndex('geteilt', 'latlng');")
+
+    await db.execute("""CREATE TABLE IF NOT EXISTS subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        user_lang VARCHAR(2),
+        type VARCHAR(10),
+        kind VARCHAR(10),
+        lat FLOAT,
+        lng FLOAT,
+        distance INTEGER,
+        inserted_at TEXT
+        );""")
+    await db.execute("SELECT AddGeometryColumn('subscriptions', 'latlng', 4326, 'POINT', 'XY');")
+    await db.execute("SELECT CreateSpatialIndex('subscriptions', 'latlng');")
+
+async def convert_vacuum(db):
+    # switching an existing file to incremental auto-vacuum needs one full
+    # VACUUM, which can't run inside a migration's transaction, so it isn't
+    # a step of MIGRATIONS. The write lock waits for a VACUUM running in
+    # another process
+    await db.execute("BEGIN IMMEDIATE;")
+    async with db.execute("PRAGMA auto_vacuum;") as cursor:
+        auto_vacuum = (await cursor.fetchone())[0]
+    await db.rollback()
+    if auto_vacuum == 2:
+        return
+    try:
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        await db.execute("VACUUM;")
+    except aiosqlite.OperationalError:
+        # another process is converting the file or holds it locked; the
+        # purge works without it, only the file doesn't shrink yet. The next
+        # start tries again
+        logging.warning('VACUUM for incremental auto-vacuum skipped, the database is busy')
+
+async def upgrade_indexes(db):
+    await db.execute("CREATE INDEX IF NOT EXISTS geteilt_expires_at ON geteilt(expires_at);")
+    await db.execute("CREATE INDEX IF NOT EXISTS geteilt_type_kind_expires_at ON geteilt(type, kind, expires_at);")
+    await db.execute("CREATE INDEX IF NOT EXISTS geteilt_user_id ON geteilt(user_id);")
+    await db.execute("CREATE INDEX IF NOT EXISTS subscriptions_user_id ON subscriptions(user_id);")
+    await db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS subscriptions_rtree USING rtree(id, min_lng, max_lng, min_lat, max_lat);")
+    await db.execute("CREATE INDEX IF NOT EXISTS subscriptions_everywhere ON subscriptions(type, kind) WHERE latlng IS NULL;")
+    async with db.execute("""SELECT id, lat, lng, distance FROM subscriptions
+            WHERE latlng IS NOT NULL AND id NOT IN (SELECT id FROM subscriptions_rtree);""") as cursor:
+        missing = await cursor.fetchall()
+    for subscription_id, lat, lng, distance in missing:
+        await add_subscription_box(db, subscription_id, lat, lng, distance)
+
+async def upgrade_routing(db):
+    await db.execute("""CREATE TABLE IF NOT EXISTS shards (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        node TEXT
+        );""")
+    await db.execute("""CREATE TABLE IF NOT EXISTS shard_cells (
+        cell_lat INTEGER,
+        cell_lng INTEGER,
+        shard INTEGER NOT NULL,
+        PRIMARY KEY (cell_lat, cell_lng)
+        ) WITHOUT ROWID;""")
+    # the cell size is fixed once the first cell was assigned
+    await db.execute("CREATE TABLE IF NOT EXISTS shard_settings (name TEXT PRIMARY KEY, value);")
+    await db.execute("INSERT OR IGNORE INTO shard_settings(name, value) VALUES ('cell_degrees', ?);", (CELL_DEGREES,))
+
+async def upgrade_recency(db):
+    # newest first pages walk this index, see entry_page_query
+    await db.execute("CREATE INDEX IF NOT EXISTS geteilt_inserted_at ON geteilt(inserted_at);")
+
+# Every schema change in order, a database at version n has run the first n
+# of them. Each one also has to cope with databases from before
+# schema_version existed. Append new ones, never reorder or edit old ones.
+MIGRATIONS = [
+    create_tables,
+    upgrade_indexes,
+    upgrade_fts,
+    upgrade_delivery,
+    upgrade_routing,
+    upgrade_recency,
+]
+
+async def migrate(db):
+    # takes effect on a new, empty file only, so it needs no VACUUM there;
+    # older files are converted by convert_vacuum
+    await db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    # each migration runs in a transaction holding the write lock, which
+    # serializes processes starting on the same file; the version is read
+    # after taking the lock, so a step never runs twice. A single lookup on
+    # a database that is up to date
+    async with db.execute(f"PRAGMA busy_timeout = {MIGRATION_TIMEOUT * 1000};"):
+        pass
+    try:
+        while True:
+            await db.execute("BEGIN IMMEDIATE;")
+            try:
+                await db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);")
+                async with db.execute("SELECT version FROM schema_version;") as cursor:
+                    row = await cursor.fetchone()
+                version = row[0] if row else 0
+                if version >= len(MIGRATIONS):
+                    await db.commit()
+                    break
+                await MIGRATIONS[version](db)
+                await db.execute("DELETE FROM schema_version;")
+                await db.execute("INSERT INTO schema_version(version) VALUES (?);", (version + 1,))
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        await convert_vacuum(db)
+    finally:
+        # back to the timeout from PRAGMAS
+        async with db.execute("PRAGMA busy_timeout = 5000;"):
+            pass
+
+async def set_id_base(db, shard):
+    # AUTOINCREMENT continues after the highest sqlite_sequence value, so the
+    # shard's ids start at its base; under the write lock, sqlite_sequence
+    # would take a second row for a table otherwise
+    base = id_base(shard)
+    await db.execute("BEGIN IMMEDIATE;")
+    for table in ('geteilt', 'subscriptions'):
+        async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = ?;", (table,)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            await db.execute("INSERT INTO sqlite_sequence(name, seq) VALUES (?, ?);", (table, base))
+        elif row[0] < base:
+            await db.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?;", (base, table))
+    await db.commit()
+
+async def migrate_shard(shard):
+    async with connection(shard) as db:
+        await migrate(db)
+        if shard != 0:
+            await set_id_base(db, shard)
+
+async def read_routing():
+    # loads the routing table of the main database into shard_map
+    async with connection() as db:
+        async with db.execute("SELECT value FROM shard_settings WHERE name = 'cell_degrees';") as cursor:
+            cell_degrees = float((await cursor.fetchone())[0])
+        async with db.execute("SELECT id, path, node FROM shards;") as cursor:
+            shards = await cursor.fetchall()
+        async with db.execute("SELECT cell_lat, cell_lng, shard FROM shard_cells;") as cursor:
+            cells = await cursor.fetchall()
+    shard_map.load(cell_degrees, shards, cells)
+
+async def open_pools():
+    for shard in shard_map.all():
+        if shard not in pools:
+            pools[shard] = ConnectionPool(shard_path(shard), pool_size)
+        await pools[shard].open()
+
+async def migrate_db():
+    # migrations run on pooled connections, so SpatiaLite is loaded once per
+    # connection and not again for a separate setup connection
+    with phase('db migrations'):
+        await migrate_shard(0)
+    with phase('db routing'):
+        await read_routing()
+    with phase('db pools'):
+        await open_pools()
+    with phase('db shard migrations'):
+        for shard in shard_map.all()[1:]:
+            await migrate_shard(shard)
+
+async def init_db(migrations=True):
+    # without migrations the schema has to be up to date already, like in the
+    # webhook workers whose front end ran migrate_db() before starting them
+    if migrations:
+        await migrate_db()
+    else:
+        with phase('db routing'):
+            await read_routing()
+        with phase('db pools'):
+            await open_pools()
+    with phase('subscription index'):
+        await load_subscription_index()
+    if entry_snapshot is not None:
+        with phase('entry snapshot'):
+            await load_entry_snapshot()
+
+async def close_db():
+    for shard_pool in pools.values():
+        await shard_pool.close()
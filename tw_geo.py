@@ -0,0 +1,25 @@
+import math
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+def haversine(lat1, lng1, lat2, lng2):
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    h = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+def bounding_box(latitude, longitude, meters):
+    # a slightly generous lat/lng box around the search circle; it only has to
+    # contain every candidate, the exact distance check happens afterwards
+    dlat = meters * 1.01 / METERS_PER_DEGREE
+    dlng = meters * 1.01 / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    min_lat = max(latitude - dlat, -90.0)
+    max_lat = min(latitude + dlat, 90.0)
+    min_lng = longitude - dlng
+    max_lng = longitude + dlng
+    if min_lng < -180.0 or max_lng > 180.0 or min_lat == -90.0 or max_lat == 90.0:
+        min_lng, max_lng = -180.0, 180.0
+    return min_lng, min_lat, max_lng, max_lat
@@ -0,0 +1,89 @@
+import os
+import re
+import glob
+import yaml
+from contextvars import ContextVar
+from contextlib import contextmanager
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+TRANSLATIONS_DIR = 'translations'
+FALLBACK_LOCALE = 'en'
+PLACEHOLDER = re.compile(r'%\{(\w+)\}')
+
+# locale of the update currently being handled; every update runs in its own
+# task, so concurrent handlers can't see each other's value
+current_locale = ContextVar('current_locale', default=FALLBACK_LOCALE)
+translations = {}
+# display text -> keys, per locale and across all locales, for turning
+# keyboard button presses back into keys
+reverse_translations = {}
+reverse_any_locale = {}
+
+def flatten(tree, prefix=''):
+    flat = {}
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = str(value)
+    return flat
+
+def load_translations(path=TRANSLATIONS_DIR):
+    # translations/tw_bot.<locale>.yml, each with the locale as top-level key;
+    # missing keys are filled in from the fallback locale up front
+    loaded = {}
+    for file_name in sorted(glob.glob(os.path.join(path, 'tw_bot.*.yml'))):
+        with open(file_name, encoding='utf-8') as f:
+            for locale, tree in (yaml.safe_load(f) or {}).items():
+                loaded.setdefault(locale, {}).update(flatten(tree))
+    fallback = loaded.get(FALLBACK_LOCALE, {})
+    translations.clear()
+    reverse_translations.clear()
+    reverse_any_locale.clear()
+    for locale, table in loaded.items():
+        translations[locale] = {**fallback, **table}
+        reverse = reverse_translations[locale] = {}
+        for key, text in translations[locale].items():
+            reverse[text] = reverse.get(text, ()) + (key,)
+            if key not in reverse_any_locale.get(text, ()):
+                reverse_any_locale[text] = reverse_any_locale.get(text, ()) + (key,)
+
+def translate(key, locale=None, **kwargs):
+    table = translations.get(locale or current_locale.get())
+    if table is None:
+        table = translations.get(FALLBACK_LOCALE, {})
+    text = table.get(key, key)
+    if kwargs:
+        text = PLACEHOLDER.sub(lambda m: str(kwargs.get(m.group(1), m.group(0))), text)
+    return text
+
+def parse_key(text, keys, locale=None):
+    # the key among keys whose translation is text, preferring the user's
+    # locale but accepting button texts of any supported locale
+    for key in reverse_translations.get(locale or current_locale.get(), {}).get(text, ()):
+        if key in keys:
+            return key
+    for key in reverse_any_locale.get(text, ()):
+        if key in keys:
+            return key
+    return None
+
+def user_locale(user):
+    if user is None or not user.language_code:
+        return FALLBACK_LOCALE
+    return user.language_code.split('-')[0].lower()
+
+@contextmanager
+def use_locale(locale):
+    token = current_locale.set(locale)
+    try:
+        yield
+    finally:
+        current_locale.reset(token)
+
+class LocaleMiddleware(BaseMiddleware):
+    async def on_pre_process_message(self, message, data):
+        current_locale.set(user_locale(message.from_user))
+
+    async def on_pre_process_callback_query(self, query, data):
+        current_locale.set(user_locale(query.from_user))
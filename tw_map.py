@@ -1,161 +1,267 @@
-import staticmaps
-import cairo
-import s2sphere
+import os
 import io
+import time
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from tw_metrics import Counter, Histogram
+from tw_startup import phase
+
+MAP_EXECUTOR = os.environ.get('TW_MAP_EXECUTOR', 'process')
+MAP_WORKERS = int(os.environ.get('TW_MAP_WORKERS', '2'))
+MAP_QUEUE_SIZE = int(os.environ.get('TW_MAP_QUEUE_SIZE', '16'))
+MAP_CACHE_BYTES = int(os.environ.get('TW_MAP_CACHE_BYTES', str(32 * 1024 * 1024)))
+MAP_FILE_IDS = int(os.environ.get('TW_MAP_FILE_IDS', '10000'))
+# load the drawing stack in the render workers right after startup instead of
+# on the first map
+MAP_PREWARM = os.environ.get('TW_MAP_PREWARM', '1') == '1'
+# markers closer than this many pixels on the rendered map share one label
+MAP_MERGE_RADIUS = float(os.environ.get('TW_MAP_MERGE_RADIUS', '32'))
+
+MAP_WIDTH = 800
+MAP_HEIGHT = 500
+TILE_SIZE = 256
+# room staticmaps keeps around the markers for a TextLabel and the attribution
+LABEL_MARGIN = (24, 40, 24, 12)
+SINGLE_POINT_ZOOM = 15
+MAX_ZOOM = 17
+
+RENDER_SECONDS = Histogram('tw_map_render_seconds', 'Duration of map renders in the render pool')
+RENDER_WAIT_SECONDS = Histogram('tw_map_render_wait_seconds', 'Duration of render_map calls that had to render, queueing included')
+TILE_SECONDS = Histogram('tw_map_tile_seconds', 'Duration of tile lookups by where the tile came from', ['source'])
+MAP_REQUESTS = Counter('tw_map_requests_total', 'Map requests by how they were served', ['result'])
+
+def world_pixels(lat, lng, zoom):
+    # web mercator, the projection of the map tiles
+    scale = TILE_SIZE * 2.0 ** zoom
+    siny = np.clip(np.sin(np.radians(lat)), -0.9999, 0.9999)
+    x = (lng + 180.0) / 360.0 * scale
+    y = (0.5 - np.log((1 + siny) / (1 - siny)) / (4 * np.pi)) * scale
+    return x, y
+
+def choose_zoom(lat, lng):
+    # the zoom staticmaps will pick for these markers: the largest one at
+    # which their bounds fit into the image minus the label margins
+    x, y = world_pixels(lat, lng, 0)
+    dx = x.max() - x.min()
+    dy = y.max() - y.min()
+    if dx == 0 and dy == 0:
+        return SINGLE_POINT_ZOOM
+    width = MAP_WIDTH - LABEL_MARGIN[0] - LABEL_MARGIN[2]
+    height = MAP_HEIGHT - LABEL_MARGIN[1] - LABEL_MARGIN[3]
+    fit = min(width / dx if dx else np.inf, height / dy if dy else np.inf)
+    return int(min(MAX_ZOOM, max(0, np.floor(np.log2(fit)))))
+
+def format_numbers(numbers):
+    # 1, 2, 3, 7 -> "1-3 + 7"; long lists are cut short
+    parts = []
+    start = prev = numbers[0]
+    for num in numbers[1:] + [None]:
+        if num is not None and num == prev + 1:
+            prev = num
+            continue
+        parts.append(str(start) if start == prev else f'{start}-{prev}')
+        start = prev = num
+    if len(parts) > 4:
+        parts = parts[:3] + ['…']
+    return ' + '.join(parts)
+
+def merge_markers(locations, first=1, radius=MAP_MERGE_RADIUS):
+    # Merges markers that would overlap on the rendered map into one label
+    # listing their numbers. Markers are projected to pixels at the zoom the
+    # map will be drawn at and snapped to a grid of radius sized cells, then
+    # neighbouring cells whose centres are closer than radius are joined.
+    if not locations:
+        return []
+    points = np.asarray(locations, dtype=float)
+    lat, lng = points[:, 0], points[:, 1]
+    x, y = world_pixels(lat, lng, choose_zoom(lat, lng))
+
+    cells = np.stack([np.floor(x / radius), np.floor(y / radius)], axis=1).astype(np.int64)
+    cells, group = np.unique(cells, axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    counts = np.bincount(group)
+    cx = np.bincount(group, weights=x) / counts
+    cy = np.bincount(group, weights=y) / counts
+
+    # union-find over the occupied cells, each one only looks at the cells
+    # after it among its eight neighbours
+    parent = list(range(len(cells)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    occupied = {(int(gx), int(gy)): i for i, (gx, gy) in enumerate(cells)}
+    for i, (gx, gy) in enumerate(cells):
+        for nx, ny in ((gx + 1, gy - 1), (gx + 1, gy), (gx + 1, gy + 1), (gx, gy + 1)):
+            j = occupied.get((int(nx), int(ny)))
+            if j is not None and (cx[i] - cx[j]) ** 2 + (cy[i] - cy[j]) ** 2 < radius ** 2:
+                parent[find(i)] = find(j)
+    cluster = np.array([find(g) for g in range(len(cells))])[group]
 
-# https://github.com/flopp/py-staticmaps/blob/master/examples/custom_objects.py
-class TextLabel(staticmaps.Object):
-    def __init__(self, latlng: s2sphere.LatLng, text: str) -> None:
-        staticmaps.Object.__init__(self)
-        self._latlng = latlng
-        self._text = text
-        self._margin = 4
-        self._arrow = 16
-        self._font_size = 12
-
-    def latlng(self) -> s2sphere.LatLng:
-        return self._latlng
-
-    def bounds(self) -> s2sphere.LatLngRect:
-        return s2sphere.LatLngRect.from_point(self._latlng)
-
-    def extra_pixel_bounds(self) -> staticmaps.PixelBoundsT:
-        # Guess text extents.
-        tw = len(self._text) * self._font_size * 0.5
-        th = self._font_size * 1.2
-        w = max(self._arrow, tw + 2.0 * self._margin)
-        return (int(w / 2.0), int(th + 2.0 * self._margin + self._arrow), int(w / 2), 0)
-
-    def render_pillow(self, renderer: staticmaps.PillowRenderer) -> None:
-        x, y = renderer.transformer().ll2pixel(self.latlng())
-        x = x + renderer.offset_x()
-
-        tw, th = renderer.draw().textsize(self._text)
-        w = max(self._arrow, tw + 2 * self._margin)
-        h = th + 2 * self._margin
-
-        path = [
-            (x, y),
-            (x + self._arrow / 2, y - self._arrow),
-            (x + w / 2, y - self._arrow),
-            (x + w / 2, y - self._arrow - h),
-            (x - w / 2, y - self._arrow - h),
-            (x - w / 2, y - self._arrow),
-            (x - self._arrow / 2, y - self._arrow),
-        ]
-
-        renderer.draw().polygon(path, fill=(255, 255, 255, 255))
-        renderer.draw().line(path, fill=(255, 0, 0, 255))
-        renderer.draw().text((x - tw / 2, y - self._arrow - h / 2 - th / 2), self._text, fill=(0, 0, 0, 255))
-
-    def render_cairo(self, renderer: staticmaps.CairoRenderer) -> None:
-        x, y = renderer.transformer().ll2pixel(self.latlng())
-
-        ctx = renderer.context()
-        ctx.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-
-        ctx.set_font_size(self._font_size)
-        x_bearing, y_bearing, tw, th, _, _ = ctx.text_extents(self._text)
-
-        w = max(self._arrow, tw + 2 * self._margin)
-        h = th + 2 * self._margin
-
-        path = [
-            (x, y),
-            (x + self._arrow / 2, y - self._arrow),
-            (x + w / 2, y - self._arrow),
-            (x + w / 2, y - self._arrow - h),
-            (x - w / 2, y - self._arrow - h),
-            (x - w / 2, y - self._arrow),
-            (x - self._arrow / 2, y - self._arrow),
-        ]
-
-        ctx.set_source_rgb(1, 1, 1)
-        ctx.new_path()
-        for p in path:
-            ctx.line_to(*p)
-        ctx.close_path()
-        ctx.fill()
-
-        ctx.set_source_rgb(1, 0, 0)
-        ctx.set_line_width(1)
-        ctx.new_path()
-        for p in path:
-            ctx.line_to(*p)
-        ctx.close_path()
-        ctx.stroke()
-
-        ctx.set_source_rgb(0, 0, 0)
-        ctx.set_line_width(1)
-        ctx.move_to(x - tw / 2 - x_bearing, y - self._arrow - h / 2 - y_bearing - th / 2)
-        ctx.show_text(self._text)
-        ctx.stroke()
-
-    def render_svg(self, renderer: staticmaps.SvgRenderer) -> None:
-        x, y = renderer.transformer().ll2pixel(self.latlng())
-
-        # guess text extents
-        tw = len(self._text) * self._font_size * 0.5
-        th = self._font_size * 1.2
-
-        w = max(self._arrow, tw + 2 * self._margin)
-        h = th + 2 * self._margin
-
-        path = renderer.drawing().path(
-            fill="#ffffff",
-            stroke="#ff0000",
-            stroke_width=1,
-            opacity=1.0,
-        )
-        path.push(f"M {x} {y}")
-        path.push(f" l {self._arrow / 2} {-self._arrow}")
-        path.push(f" l {w / 2 - self._arrow / 2} 0")
-        path.push(f" l 0 {-h}")
-        path.push(f" l {-w} 0")
-        path.push(f" l 0 {h}")
-        path.push(f" l {w / 2 - self._arrow / 2} 0")
-        path.push("Z")
-        renderer.group().add(path)
-
-        renderer.group().add(
-            renderer.drawing().text(
-                self._text,
-                text_anchor="middle",
-                dominant_baseline="central",
-                insert=(x, y - self._arrow - h / 2),
-                font_family="sans-serif",
-                font_size=f"{self._font_size}px",
-                fill="#000000",
-            )
-        )
-
-async def render_map(locations):
-    context = staticmaps.Context()
-    context.set_tile_provider(staticmaps.tile_provider_OSM)
-
-    # merge markers that would end up overlapping
-    # doing this "properly" would require a 2nd pass, so..
-    num = 1
     markers = []
-    for loc in locations:
-        str_loc_lat = f'{loc[0]:.4f}'
-        str_loc_lng = f'{loc[1]:.4f}'
-        merged = False
-        for idx, m in enumerate(markers):
-            if not merged and m[0] == str_loc_lat and m[1] == str_loc_lng:
-                markers[idx] = (m[0], m[1], m[2] + " + " + str(num), m[3], m[4])
-                merged = True
-        if not merged:
-            markers.append((str_loc_lat, str_loc_lng, str(num), loc[0], loc[1]))
-        num += 1
-
-    for m in markers:
-        poi = staticmaps.create_latlng(m[3], m[4])
-        context.add_object(TextLabel(poi, m[2]))
-    
-    image = context.render_cairo(800, 500)
-    png_bytes = io.BytesIO()
-    image.write_to_png(png_bytes)
-    png_bytes.flush()
-    png_bytes.seek(0)
-    return png_bytes
\ No newline at end of file
+    order = np.argsort(cluster, kind='stable')
+    bounds = np.flatnonzero(np.diff(cluster[order])) + 1
+    for members in np.split(order, bounds):
+        numbers = [first + int(i) for i in members]
+        markers.append((numbers[0], format_numbers(numbers), float(lat[members].mean()), float(lng[members].mean())))
+    # labelled in the order of their lowest number
+    markers.sort()
+    return [(label, m_lat, m_lng) for _, label, m_lat, m_lng in markers]
+
+renderer = None
+
+def load_renderer():
+    # tw_render is only imported where maps are drawn: in the render pool
+    # processes, or in its threads
+    global renderer
+    if renderer is None:
+        import tw_render
+        renderer = tw_render
+    return renderer
+
+def render_png(markers):
+    return load_renderer().render_png(markers)
+
+def warm_renderer():
+    load_renderer().warm()
+
+executor = None
+render_slots = None
+
+def get_executor():
+    global executor, render_slots
+    if executor is None:
+        if MAP_EXECUTOR == 'thread':
+            executor = ThreadPoolExecutor(MAP_WORKERS, thread_name_prefix='render_map')
+        else:
+            # forking a process that already runs the event loop, aiosqlite
+            # and notifier threads can leave a child stuck on a copied lock
+            executor = ProcessPoolExecutor(MAP_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+    if render_slots is None:
+        # at most MAP_WORKERS renders run while MAP_QUEUE_SIZE more wait in the
+        # executor, every further caller waits here without blocking the loop
+        render_slots = asyncio.Semaphore(MAP_WORKERS + MAP_QUEUE_SIZE)
+    return executor
+
+def replace_executor(pool):
+    # a dead render process (out of memory, a crash in cairo) breaks the
+    # whole pool, every later submit would fail
+    global executor
+    if executor is pool:
+        logging.warning('The map render pool broke, starting a new one')
+        executor = None
+        pool.shutdown(wait=False)
+    return get_executor()
+
+async def prewarm_renderer():
+    # one warm-up per worker; a process pool may hand two to the same worker,
+    # the other one then warms up on its first map
+    loop = asyncio.get_running_loop()
+    pool = get_executor()
+    try:
+        with phase('map renderer warm-up'):
+            await asyncio.gather(*[loop.run_in_executor(pool, warm_renderer) for _ in range(MAP_WORKERS)])
+    except Exception:
+        logging.exception('Pre-warming the map renderer failed')
+
+def map_key(markers):
+    canonical = ';'.join(f'{label}@{lat:.5f},{lng:.5f}' for label, lat, lng in markers)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+# rendered PNGs by map_key, least recently used first, bounded by MAP_CACHE_BYTES
+png_cache = OrderedDict()
+png_cache_bytes = 0
+# Telegram file_id of the first upload of each map, so repeats skip the upload
+file_ids = OrderedDict()
+pending_renders = {}
+
+def cache_png(key, png):
+    global png_cache_bytes
+    png_cache_bytes += len(png) - len(png_cache.pop(key, b''))
+    png_cache[key] = png
+    while png_cache_bytes > MAP_CACHE_BYTES and len(png_cache) > 1:
+        _, old = png_cache.popitem(last=False)
+        png_cache_bytes -= len(old)
+
+async def render_markers(key, markers):
+    png = png_cache.get(key)
+    if png is not None:
+        png_cache.move_to_end(key)
+        MAP_REQUESTS.inc(result='cached')
+        return png
+    # concurrent requests for the same map (e.g. one notification per
+    # subscriber) share a single render. It runs as its own task, so a
+    # cancelled request doesn't take the map away from the others
+    pending = pending_renders.get(key)
+    if pending is not None:
+        MAP_REQUESTS.inc(result='shared')
+    else:
+        MAP_REQUESTS.inc(result='rendered')
+        pending = asyncio.create_task(render_shared(key, markers))
+        # mark a failure retrieved, nobody may be waiting for it anymore
+        pending.add_done_callback(lambda task: task.cancelled() or task.exception())
+        pending_renders[key] = pending
+    return await asyncio.shield(pending)
+
+async def render_shared(key, markers):
+    start = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        pool = get_executor()
+        async with render_slots:
+            try:
+                png, seconds, tiles = await loop.run_in_executor(pool, render_png, markers)
+            except BrokenProcessPool:
+                # once; a map that kills the new pool too fails
+                pool = replace_executor(pool)
+                png, seconds, tiles = await loop.run_in_executor(pool, render_png, markers)
+        RENDER_SECONDS.observe(seconds)
+        for source, tile_seconds in tiles:
+            TILE_SECONDS.observe(tile_seconds, source=source)
+        RENDER_WAIT_SECONDS.observe(time.perf_counter() - start)
+        cache_png(key, png)
+        return png
+    finally:
+        del pending_renders[key]
+
+async def render_map(locations, first=1):
+    markers = merge_markers(locations, first)
+    return io.BytesIO(await render_markers(map_key(markers), markers))
+
+async def map_photo(locations, first=1):
+    # returns a key for remember_file_id() and either a known Telegram file_id
+    # or the rendered PNG
+    markers = merge_markers(locations, first)
+    key = map_key(markers)
+    file_id = file_ids.get(key)
+    if file_id is not None:
+        file_ids.move_to_end(key)
+        MAP_REQUESTS.inc(result='file_id')
+        return key, file_id
+    return key, io.BytesIO(await render_markers(key, markers))
+
+def remember_file_id(key, message):
+    if not message.photo:
+        return
+    file_ids[key] = message.photo[-1].file_id
+    file_ids.move_to_end(key)
+    while len(file_ids) > MAP_FILE_IDS:
+        file_ids.popitem(last=False)
+
+def forget_file_id(key):
+    file_ids.pop(key, None)
+
+def shutdown_renderer():
+    global executor, render_slots
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
+        render_slots = None
@@ -0,0 +1,251 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from functools import wraps
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter
+
+# Prometheus text exposition of counters, gauges and histograms, served on
+# http://<TW_METRICS_HOST>:<TW_METRICS_PORT>/metrics when a port is set, next
+# to a /ready probe.
+# Timings are taken for a TW_METRICS_SAMPLE fraction of calls only and scaled
+# back up, so counts and sums still estimate the totals.
+METRICS_HOST = os.environ.get('TW_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.environ.get('TW_METRICS_PORT')
+METRICS_SAMPLE = min(1.0, max(0.0, float(os.environ.get('TW_METRICS_SAMPLE', '1'))))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []
+# flipped by the bot once it can serve updates, answered on /ready
+ready = False
+# coroutine functions run before every scrape, e.g. to update gauges from the db
+collectors = []
+
+def sampled():
+    return METRICS_SAMPLE >= 1.0 or random.random() < METRICS_SAMPLE
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, le=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{format_value(le)}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f'{self.name}{format_labels(self.labels, key)} {format_value(value)}']
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def replace(self, values):
+        # sets all label combinations at once, e.g. {('state',): count}
+        with self._lock:
+            self._values = dict(values)
+
+class CallbackGauge(Gauge):
+    # reads its single value from func at scrape time
+    def __init__(self, name, help, func):
+        Gauge.__init__(self, name, help)
+        self._func = func
+
+    def expose(self):
+        self.set(self._func())
+        return Gauge.expose(self)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, weight=1.0, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0.0] * (len(self.buckets) + 1), 0.0, 0.0]
+            state[0][index] += weight
+            state[1] += value * weight
+            state[2] += weight
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0.0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{format_labels(self.labels, key, bound)} {format_value(cumulative)}')
+        lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}')
+        lines.append(f'{self.name}_count{format_labels(self.labels, key)} {format_value(count)}')
+        return lines
+
+def sample_weight():
+    # None if this call is not sampled, otherwise the weight of its observation
+    if not sampled():
+        return None
+    return 1.0 / METRICS_SAMPLE
+
+def timed(histogram, **labels):
+    # decorator recording the duration of a (coroutine) function, exceptions
+    # included, for the sampled fraction of calls
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                weight = sample_weight()
+                if weight is None:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, weight, **labels)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                weight = sample_weight()
+                if weight is None:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, weight, **labels)
+        return wrapper
+    return decorator
+
+TELEGRAM_SECONDS = Histogram('tw_telegram_request_seconds', 'Duration of Telegram Bot API requests', ['method'])
+TELEGRAM_FLOOD_WAITS = Counter('tw_telegram_flood_waits_total', 'Requests rejected with a flood wait', ['method'])
+TELEGRAM_FLOOD_WAIT_SECONDS = Counter('tw_telegram_flood_wait_seconds_total', 'Seconds Telegram asked us to wait', ['method'])
+HANDLER_SECONDS = Histogram('tw_handler_seconds', 'Duration of update handlers', ['handler'])
+
+class MetricsBot(Bot):
+    # every API call goes through request(), so this times them all
+    async def request(self, method, data=None, files=None, **kwargs):
+        weight = sample_weight()
+        start = time.perf_counter()
+        try:
+            return await Bot.request(self, method, data, files, **kwargs)
+        except RetryAfter as e:
+            TELEGRAM_FLOOD_WAITS.inc(method=method)
+            TELEGRAM_FLOOD_WAIT_SECONDS.inc(e.timeout, method=method)
+            raise
+        finally:
+            if weight is not None:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - start, weight, method=method)
+
+class MetricsMiddleware(BaseMiddleware):
+    # process_* runs right before the matched handler, post_process_* after it
+    async def on_process_message(self, message, data):
+        self.start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self.stop(data)
+
+    async def on_process_callback_query(self, query, data):
+        self.start(data)
+
+    async def on_post_process_callback_query(self, query, results, data):
+        self.stop(data)
+
+    def start(self, data):
+        weight = sample_weight()
+        if weight is not None:
+            data['metrics_timer'] = (current_handler.get().__name__, time.perf_counter(), weight)
+
+    def stop(self, data):
+        timer = data.pop('metrics_timer', None)
+        if timer is not None:
+            handler, start, weight = timer
+            HANDLER_SECONDS.observe(time.perf_counter() - start, weight, handler=handler)
+
+def expose():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+async def collect():
+    for collector in collectors:
+        try:
+            await collector()
+        except Exception:
+            logging.exception('Metrics collector %s failed', collector.__name__)
+
+async def handle_metrics(request):
+    from aiohttp import web
+    await collect()
+    return web.Response(body=expose().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+def set_ready(value=True):
+    global ready
+    ready = value
+
+async def handle_ready(request):
+    from aiohttp import web
+    if ready:
+        return web.Response(text='ready\n')
+    return web.Response(status=503, text='starting\n')
+
+async def start_metrics_server(port, host=METRICS_HOST):
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/ready', handle_ready)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info('Serving metrics on http://%s:%s/metrics', host, port)
+    return runner
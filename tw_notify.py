@@ -0,0 +1,122 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, ChatNotFound, UserDeactivated
+
+NOTIFY_WORKERS = int(os.environ.get('TW_NOTIFY_WORKERS', '8'))
+NOTIFY_QUEUE_SIZE = int(os.environ.get('TW_NOTIFY_QUEUE_SIZE', '10000'))
+# Telegram allows about 30 messages per second overall and one per second
+# into the same chat
+NOTIFY_GLOBAL_RATE = float(os.environ.get('TW_NOTIFY_GLOBAL_RATE', '25'))
+NOTIFY_CHAT_RATE = float(os.environ.get('TW_NOTIFY_CHAT_RATE', '1'))
+NOTIFY_RETRIES = int(os.environ.get('TW_NOTIFY_RETRIES', '3'))
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self):
+        # takes a token and returns how long the caller has to wait for it;
+        # tokens may go negative so that waiting callers queue up fairly
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self._rate)
+
+    def idle(self):
+        return self._tokens + (time.monotonic() - self._updated) * self._rate >= self._capacity
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class ChatSlot:
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate)
+        self.lock = asyncio.Lock()
+
+class NotificationDispatcher:
+    # Background fan-out of notifications: submit() queues the sends for one
+    # chat and returns, a fixed number of workers deliver them in order within
+    # the global and per-chat rate limits and retry after flood waits.
+    def __init__(self, workers=NOTIFY_WORKERS, queue_size=NOTIFY_QUEUE_SIZE,
+            global_rate=NOTIFY_GLOBAL_RATE, chat_rate=NOTIFY_CHAT_RATE, retries=NOTIFY_RETRIES):
+        self._workers = workers
+        self._queue_size = queue_size
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_rate = chat_rate
+        self._retries = retries
+        self._chats = {}
+        self._queue = None
+        self._tasks = []
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(self._queue_size)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self._workers)]
+
+    async def stop(self, drain=True):
+        if self._queue is None:
+            return
+        if drain:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queue = None
+        self._tasks = []
+
+    async def submit(self, chat_id, *sends):
+        # sends are zero-argument coroutine functions, delivered one after the
+        # other; waits only if the queue is full
+        if self._queue is None:
+            self.start()
+        await self._queue.put((chat_id, sends))
+
+    def _chat(self, chat_id):
+        slot = self._chats.get(chat_id)
+        if slot is None:
+            if len(self._chats) > 10 * self._queue_size:
+                self._chats = {k: v for k, v in self._chats.items() if not (v.bucket.idle() and not v.lock.locked())}
+            slot = self._chats[chat_id] = ChatSlot(self._chat_rate)
+        return slot
+
+    async def _work(self):
+        while True:
+            chat_id, sends = await self._queue.get()
+            try:
+                slot = self._chat(chat_id)
+                async with slot.lock:
+                    for send in sends:
+                        if not await self._deliver(chat_id, slot, send):
+                            break
+            except Exception:
+                logging.exception('Notification to %s failed', chat_id)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, chat_id, slot, send):
+        for attempt in range(self._retries + 1):
+            await self._global.acquire()
+            await slot.bucket.acquire()
+            try:
+                await send()
+                return True
+            except RetryAfter as e:
+                logging.warning('Flood wait of %ss while notifying %s', e.timeout, chat_id)
+                await asyncio.sleep(e.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+                logging.info('Dropping notification to %s: %s', chat_id, e)
+                return False
+        logging.warning('Giving up notifying %s after %s retries', chat_id, self._retries)
+        return False
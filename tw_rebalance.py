@@ -0,0 +1,227 @@
+# Manages the geographic shards of the bot database (see tw_shards): adds
+# shard files, assigns them to bot nodes and moves cells between them. Moving
+# copies the rows of the cells to the target shard under new ids, remaps
+# pending digest entries and updates the routing table; stop the bot and back
+# up the files first, running bots only read the routing table at startup. A
+# move that was interrupted can be run again, it finishes without duplicates.
+#
+#   python tw_rebalance.py [--db db.sqlite] status [--cells]
+#   python tw_rebalance.py add-shard PATH [--node NODE]
+#   python tw_rebalance.py set-node SHARD NODE
+#   python tw_rebalance.py move SHARD MIN_LAT MIN_LNG MAX_LAT MAX_LNG
+#   python tw_rebalance.py balance SHARD [SHARD ...] [--dry-run]
+import sys
+import json
+import asyncio
+import argparse
+
+import tw_db
+from tw_db import ENTRY_INSERT, SUBSCRIPTION_INSERT, entry_insert_params, add_subscription_box, connection, fetch_all, \
+    fetch_shards, init_db, close_db, read_routing, open_pools, migrate_shard
+
+ENTRY_ROWS_QUERY = "SELECT id, user_id, user_lang, type, kind, lat, lng, desc, inserted_at, expires_at FROM geteilt;"
+SUBSCRIPTION_ROWS_QUERY = """SELECT id, user_id, user_lang, type, kind, lat, lng, distance, inserted_at, delivery FROM subscriptions
+    WHERE latlng IS NOT NULL;"""
+
+async def cell_loads():
+    # (entries, subscriptions) per occupied cell, wherever the rows are stored,
+    # and the cells with rows outside the shard they are routed to, which an
+    # interrupted move leaves behind
+    shard_map = tw_db.shard_map
+    loads = {}
+    misplaced = set()
+    for column, query in enumerate(["SELECT lat, lng FROM geteilt;", "SELECT lat, lng FROM subscriptions WHERE latlng IS NOT NULL;"]):
+        for shard, rows in zip(shard_map.all(), await fetch_shards(query, (), shard_map.all())):
+            for lat, lng in rows:
+                cell = shard_map.cell(lat, lng)
+                counts = loads.setdefault(cell, [0, 0])
+                counts[column] += 1
+                if shard_map.cells.get(cell, 0) != shard:
+                    misplaced.add(cell)
+    return loads, misplaced
+
+async def status(args):
+    shard_map = tw_db.shard_map
+    entries = await fetch_shards("SELECT count(*) FROM geteilt;", (), shard_map.all())
+    subscriptions = await fetch_shards("SELECT count(*) FROM subscriptions;", (), shard_map.all())
+    cells = {}
+    for shard in shard_map.cells.values():
+        cells[shard] = cells.get(shard, 0) + 1
+    print(f'cell size {shard_map.cell_degrees} degrees')
+    print(f'{"shard":>5} {"node":<12} {"cells":>6} {"entries":>9} {"subs":>9}  path')
+    for shard, entry_count, subscription_count in zip(shard_map.all(), entries, subscriptions):
+        node = shard_map.shards[shard][1] or '-'
+        assigned = cells.get(shard, 0) if shard else 'rest'
+        print(f'{shard:>5} {node:<12} {assigned:>6} {entry_count[0][0]:>9} {subscription_count[0][0]:>9}  {tw_db.shard_path(shard)}')
+    loads, misplaced = await cell_loads()
+    if misplaced:
+        print(f'{len(misplaced)} cells have rows outside their shard, run the interrupted move or balance again')
+    if args.cells:
+        print(f'{"cell":>12} {"shard":>5} {"entries":>9} {"subs":>9}')
+        for cell, (entry_count, subscription_count) in sorted(loads.items(), key=lambda item: -sum(item[1])):
+            print(f'{cell[0]:>5},{cell[1]:>6} {shard_map.cells.get(cell, 0):>5} {entry_count:>9} {subscription_count:>9}')
+
+async def add_shard(args):
+    async with connection() as db:
+        async with db.execute("INSERT INTO shards(path, node) VALUES (?, ?);", (args.path, args.node)) as cursor:
+            shard = cursor.lastrowid
+        await db.commit()
+    await read_routing()
+    await open_pools()
+    await migrate_shard(shard)
+    print(f'added shard {shard} at {tw_db.shard_path(shard)}')
+
+async def set_node(args):
+    async with connection() as db:
+        await db.execute("UPDATE shards SET node = ? WHERE id = ?;", (args.node, args.shard))
+        await db.commit()
+
+async def copied_rows(db, query, cells):
+    # rows of the cells already in target, left by a move that didn't get to
+    # the deletes; by content, as they were copied under new ids
+    copied = {}
+    async with db.execute(query) as cursor:
+        async for row in cursor:
+            if tw_db.shard_map.cell(row[5], row[6]) in cells:
+                copied.setdefault(tuple(row[1:]), []).append(row[0])
+    return copied
+
+async def copy_rows(target, cells, entries, subscriptions):
+    # inserts the rows into target under new ids, returns old -> new entry ids;
+    # the target only has rows in cells that aren't routed to it yet if an
+    # earlier move stopped halfway, those are taken over instead of copied again
+    entry_ids = {}
+    async with connection(target) as db:
+        await db.execute("BEGIN IMMEDIATE;")
+        copied = await copied_rows(db, ENTRY_ROWS_QUERY, cells)
+        for row in entries:
+            if copied.get(tuple(row[1:])):
+                entry_ids[row[0]] = copied[tuple(row[1:])].pop()
+                continue
+            async with db.execute(ENTRY_INSERT, entry_insert_params(row[1:])) as cursor:
+                entry_ids[row[0]] = cursor.lastrowid
+        copied = await copied_rows(db, SUBSCRIPTION_ROWS_QUERY, cells)
+        for row in subscriptions:
+            if copied.get(tuple(row[1:])):
+                copied[tuple(row[1:])].pop()
+                continue
+            async with db.execute(SUBSCRIPTION_INSERT, (None,) + tuple(row[1:]) + (row[6], row[5])) as cursor:
+                subscription_id = cursor.lastrowid
+            await add_subscription_box(db, subscription_id, row[5], row[6], row[7])
+        await db.commit()
+    return entry_ids
+
+async def delete_rows(shard, entry_ids, subscription_ids):
+    async with connection(shard) as db:
+        await db.execute("DELETE FROM geteilt WHERE id IN (SELECT value FROM json_each(?));", (json.dumps(entry_ids),))
+        await db.execute("DELETE FROM subscriptions WHERE id IN (SELECT value FROM json_each(?));", (json.dumps(subscription_ids),))
+        await db.execute("DELETE FROM subscriptions_rtree WHERE id IN (SELECT value FROM json_each(?));", (json.dumps(subscription_ids),))
+        await db.commit()
+
+async def move_cells(cells, target):
+    shard_map = tw_db.shard_map
+    cells = set(cells)
+    moved = [0, 0]
+    for source in shard_map.all():
+        if source == target:
+            continue
+        entries = [row for row in await fetch_all(ENTRY_ROWS_QUERY, (), source) if shard_map.cell(row[5], row[6]) in cells]
+        subscriptions = [row for row in await fetch_all(SUBSCRIPTION_ROWS_QUERY, (), source) if shard_map.cell(row[5], row[6]) in cells]
+        if not entries and not subscriptions:
+            continue
+        entry_ids = await copy_rows(target, cells, entries, subscriptions)
+        async with connection() as db:
+            await db.executemany("UPDATE pending_notifications SET entry_id = ? WHERE entry_id = ?;",
+                [(new, old) for old, new in entry_ids.items()])
+            await db.commit()
+        await delete_rows(source, list(entry_ids), [row[0] for row in subscriptions])
+        moved[0] += len(entries)
+        moved[1] += len(subscriptions)
+    async with connection() as db:
+        await db.executemany("DELETE FROM shard_cells WHERE cell_lat = ? AND cell_lng = ?;", list(cells))
+        if target != 0:
+            await db.executemany("INSERT INTO shard_cells(cell_lat, cell_lng, shard) VALUES (?, ?, ?);",
+                [cell + (target,) for cell in cells])
+        await db.commit()
+    await read_routing()
+    return moved
+
+def check_shard(shard):
+    if shard not in tw_db.shard_map.shards:
+        sys.exit(f'unknown shard {shard}')
+
+async def move(args):
+    check_shard(args.shard)
+    lat0, lng0 = tw_db.shard_map.cell(args.min_lat, args.min_lng)
+    lat1, lng1 = tw_db.shard_map.cell(args.max_lat, args.max_lng)
+    cells = [(cell_lat, cell_lng) for cell_lat in range(lat0, lat1 + 1) for cell_lng in range(lng0, lng1 + 1)]
+    entries, subscriptions = await move_cells(cells, args.shard)
+    print(f'{len(cells)} cells to shard {args.shard}, moved {entries} entries and {subscriptions} subscriptions')
+
+def plan(loads, shards):
+    # cuts the occupied cells, in latitude bands, into contiguous runs of
+    # about equal load so that a radius query touches few shards
+    cells = sorted(loads)
+    total = sum(sum(load) for load in loads.values())
+    assignment = {}
+    index = 0
+    filled = 0
+    for cell in cells:
+        if filled >= total * (index + 1) / len(shards) and index < len(shards) - 1:
+            index += 1
+        assignment[cell] = shards[index]
+        filled += sum(loads[cell])
+    return assignment
+
+async def balance(args):
+    for shard in args.shards:
+        check_shard(shard)
+    loads, misplaced = await cell_loads()
+    assignment = plan(loads, args.shards)
+    targets = {}
+    for cell, shard in assignment.items():
+        if tw_db.shard_map.cells.get(cell, 0) != shard or cell in misplaced:
+            targets.setdefault(shard, []).append(cell)
+    for shard in args.shards:
+        cells = [cell for cell, target in assignment.items() if target == shard]
+        load = sum(sum(loads[cell]) for cell in cells)
+        print(f'shard {shard}: {len(cells)} cells, {load} rows, {len(targets.get(shard, []))} cells to move')
+    if args.dry_run:
+        return
+    for shard, cells in targets.items():
+        entries, subscriptions = await move_cells(cells, shard)
+        print(f'moved {entries} entries and {subscriptions} subscriptions to shard {shard}')
+
+async def main(args):
+    tw_db.use_db(args.db)
+    await init_db()
+    try:
+        await args.func(args)
+    finally:
+        await close_db()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=tw_db.DB)
+    commands = parser.add_subparsers(required=True)
+    command = commands.add_parser('status')
+    command.add_argument('--cells', action='store_true', help='list the load of every occupied cell')
+    command.set_defaults(func=status)
+    command = commands.add_parser('add-shard')
+    command.add_argument('path', help='relative to the main database')
+    command.add_argument('--node')
+    command.set_defaults(func=add_shard)
+    command = commands.add_parser('set-node')
+    command.add_argument('shard', type=int)
+    command.add_argument('node')
+    command.set_defaults(func=set_node)
+    command = commands.add_parser('move')
+    command.add_argument('shard', type=int, help='0 returns the cells to the main database')
+    for name in ('min_lat', 'min_lng', 'max_lat', 'max_lng'):
+        command.add_argument(name, type=float)
+    command.set_defaults(func=move)
+    command = commands.add_parser('balance')
+    command.add_argument('shards', type=int, nargs='+')
+    command.add_argument('--dry-run', action='store_true')
+    command.set_defaults(func=balance)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,178 @@
+import io
+import os
+import time
+import hashlib
+import staticmaps
+import cairo
+import s2sphere
+
+from tw_tiles import CachingTileDownloader
+from tw_map import MAP_WIDTH, MAP_HEIGHT
+
+# The drawing half of tw_map: staticmaps, cairo and s2sphere take a while to
+# import, so tw_map only loads this module on the first render or when the
+# renderer is pre-warmed, and so do the render pool processes.
+
+# e.g. http://localhost:8081/$z/$x/$y.png for a self-hosted tile server
+TILE_URL = os.environ.get('TW_TILE_URL')
+
+# https://github.com/flopp/py-staticmaps/blob/master/examples/custom_objects.py
+class TextLabel(staticmaps.Object):
+    def __init__(self, latlng: s2sphere.LatLng, text: str) -> None:
+        staticmaps.Object.__init__(self)
+        self._latlng = latlng
+        self._text = text
+        self._margin = 4
+        self._arrow = 16
+        self._font_size = 12
+
+    def latlng(self) -> s2sphere.LatLng:
+        return self._latlng
+
+    def bounds(self) -> s2sphere.LatLngRect:
+        return s2sphere.LatLngRect.from_point(self._latlng)
+
+    def extra_pixel_bounds(self) -> staticmaps.PixelBoundsT:
+        # Guess text extents.
+        tw = len(self._text) * self._font_size * 0.5
+        th = self._font_size * 1.2
+        w = max(self._arrow, tw + 2.0 * self._margin)
+        return (int(w / 2.0), int(th + 2.0 * self._margin + self._arrow), int(w / 2), 0)
+
+    def render_pillow(self, renderer: staticmaps.PillowRenderer) -> None:
+        x, y = renderer.transformer().ll2pixel(self.latlng())
+        x = x + renderer.offset_x()
+
+        tw, th = renderer.draw().textsize(self._text)
+        w = max(self._arrow, tw + 2 * self._margin)
+        h = th + 2 * self._margin
+
+        path = [
+            (x, y),
+            (x + self._arrow / 2, y - self._arrow),
+            (x + w / 2, y - self._arrow),
+            (x + w / 2, y - self._arrow - h),
+            (x - w / 2, y - self._arrow - h),
+            (x - w / 2, y - self._arrow),
+            (x - self._arrow / 2, y - self._arrow),
+        ]
+
+        renderer.draw().polygon(path, fill=(255, 255, 255, 255))
+        renderer.draw().line(path, fill=(255, 0, 0, 255))
+        renderer.draw().text((x - tw / 2, y - self._arrow - h / 2 - th / 2), self._text, fill=(0, 0, 0, 255))
+
+    def render_cairo(self, renderer: staticmaps.CairoRenderer) -> None:
+        x, y = renderer.transformer().ll2pixel(self.latlng())
+
+        ctx = renderer.context()
+        ctx.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+
+        ctx.set_font_size(self._font_size)
+        x_bearing, y_bearing, tw, th, _, _ = ctx.text_extents(self._text)
+
+        w = max(self._arrow, tw + 2 * self._margin)
+        h = th + 2 * self._margin
+
+        path = [
+            (x, y),
+            (x + self._arrow / 2, y - self._arrow),
+            (x + w / 2, y - self._arrow),
+            (x + w / 2, y - self._arrow - h),
+            (x - w / 2, y - self._arrow - h),
+            (x - w / 2, y - self._arrow),
+            (x - self._arrow / 2, y - self._arrow),
+        ]
+
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.new_path()
+        for p in path:
+            ctx.line_to(*p)
+        ctx.close_path()
+        ctx.fill()
+
+        ctx.set_source_rgb(1, 0, 0)
+        ctx.set_line_width(1)
+        ctx.new_path()
+        for p in path:
+            ctx.line_to(*p)
+        ctx.close_path()
+        ctx.stroke()
+
+        ctx.set_source_rgb(0, 0, 0)
+        ctx.set_line_width(1)
+        ctx.move_to(x - tw / 2 - x_bearing, y - self._arrow - h / 2 - y_bearing - th / 2)
+        ctx.show_text(self._text)
+        ctx.stroke()
+
+    def render_svg(self, renderer: staticmaps.SvgRenderer) -> None:
+        x, y = renderer.transformer().ll2pixel(self.latlng())
+
+        # guess text extents
+        tw = len(self._text) * self._font_size * 0.5
+        th = self._font_size * 1.2
+
+        w = max(self._arrow, tw + 2 * self._margin)
+        h = th + 2 * self._margin
+
+        path = renderer.drawing().path(
+            fill="#ffffff",
+            stroke="#ff0000",
+            stroke_width=1,
+            opacity=1.0,
+        )
+        path.push(f"M {x} {y}")
+        path.push(f" l {self._arrow / 2} {-self._arrow}")
+        path.push(f" l {w / 2 - self._arrow / 2} 0")
+        path.push(f" l 0 {-h}")
+        path.push(f" l {-w} 0")
+        path.push(f" l 0 {h}")
+        path.push(f" l {w / 2 - self._arrow / 2} 0")
+        path.push("Z")
+        renderer.group().add(path)
+
+        renderer.group().add(
+            renderer.drawing().text(
+                self._text,
+                text_anchor="middle",
+                dominant_baseline="central",
+                insert=(x, y - self._arrow - h / 2),
+                font_family="sans-serif",
+                font_size=f"{self._font_size}px",
+                fill="#000000",
+            )
+        )
+
+tile_downloader = None
+
+def tile_provider():
+    if TILE_URL:
+        # a name of its own per URL keeps the cached tiles apart
+        return staticmaps.TileProvider('custom-' + hashlib.sha1(TILE_URL.encode()).hexdigest()[:8], url_pattern=TILE_URL)
+    return staticmaps.tile_provider_OSM
+
+def warm():
+    # loads the tile cache index, run once in every render process
+    global tile_downloader
+    if tile_downloader is None:
+        tile_downloader = CachingTileDownloader()
+
+def render_png(markers):
+    # runs inside the render pool: tile fetching and cairo drawing block.
+    # Returns the timings along with the PNG, the pool may be another process
+    start = time.perf_counter()
+    warm()
+    tile_downloader.start_timing()
+    context = staticmaps.Context()
+    context.set_tile_provider(tile_provider())
+    context.set_tile_downloader(tile_downloader)
+    for label, lat, lng in markers:
+        poi = staticmaps.create_latlng(lat, lng)
+        context.add_object(TextLabel(poi, label))
+
+    try:
+        image = context.render_cairo(MAP_WIDTH, MAP_HEIGHT)
+    finally:
+        tiles = tile_downloader.take_timings()
+    png_bytes = io.BytesIO()
+    image.write_to_png(png_bytes)
+    return png_bytes.getvalue(), time.perf_counter() - start, tiles
@@ -0,0 +1,73 @@
+import os
+import math
+
+# Entries and located subscriptions can be spread over several SpatiaLite
+# files by coarse geographic cell of TW_SHARD_CELL_DEGREES. The main database
+# is shard 0: it keeps the routing table, the FSM state, pending digests and
+# the "everywhere" subscriptions, and it holds every cell that isn't assigned
+# to another shard, so without routing rows everything stays in one file.
+# Shard n hands out ids from n << ID_BITS on, so an id alone tells which file
+# its row lives in. Cells are moved between shards with tw_rebalance.py.
+ID_BITS = 40
+CELL_DEGREES = float(os.environ.get('TW_SHARD_CELL_DEGREES', '1'))
+# name of this bot node in the shards table, maintenance jobs only run for
+# the shards it owns; unset means all of them
+SHARD_NODE = os.environ.get('TW_SHARD_NODE')
+# boxes covering more cells than this go to every shard
+MAX_BOX_CELLS = 4096
+
+def id_base(shard):
+    return shard << ID_BITS
+
+def shard_of_id(row_id):
+    return row_id >> ID_BITS
+
+class ShardMap:
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        # shard -> (path, node); shard 0 is the main database
+        self.shards = {0: (None, None)}
+        # (cell_lat, cell_lng) -> shard, unassigned cells are in shard 0
+        self.cells = {}
+
+    def load(self, cell_degrees, shards, cells):
+        # shards as (id, path, node) and cells as (cell_lat, cell_lng, shard) rows
+        self.cell_degrees = cell_degrees
+        self.shards = {0: (None, None)}
+        for shard, path, node in shards:
+            self.shards[shard] = (path, node)
+        self.cells = {(cell_lat, cell_lng): shard for cell_lat, cell_lng, shard in cells}
+
+    def all(self):
+        return sorted(self.shards)
+
+    def owned(self, node=SHARD_NODE):
+        return [shard for shard in self.all() if node is None or self.shards[shard][1] in (None, node)]
+
+    def path(self, shard):
+        return self.shards[shard][0]
+
+    def cell(self, lat, lng):
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def for_point(self, lat, lng):
+        return self.cells.get(self.cell(lat, lng), 0)
+
+    def for_id(self, row_id):
+        # None for ids of shards that are no longer configured
+        shard = shard_of_id(row_id)
+        return shard if shard in self.shards else None
+
+    def for_box(self, min_lng, min_lat, max_lng, max_lat):
+        # every shard holding a cell that overlaps the box
+        if not self.cells:
+            return [0]
+        lat0, lng0 = self.cell(min_lat, min_lng)
+        lat1, lng1 = self.cell(max_lat, max_lng)
+        if (lat1 - lat0 + 1) * (lng1 - lng0 + 1) > MAX_BOX_CELLS:
+            return self.all()
+        found = set()
+        for cell_lat in range(lat0, lat1 + 1):
+            for cell_lng in range(lng0, lng1 + 1):
+                found.add(self.cells.get((cell_lat, cell_lng), 0))
+        return sorted(found)
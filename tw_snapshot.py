@@ -0,0 +1,182 @@
+import numpy as np
+
+from tw_geo import EARTH_RADIUS, bounding_box
+
+COLUMNS = [
+    ('ids', np.int64),
+    ('users', np.int64),
+    ('lat', np.float64),
+    ('lng', np.float64),
+    ('types', np.int32),
+    ('kinds', np.int32),
+    ('inserted', np.int64),
+    ('expires', np.int64),
+    ('alive', np.bool_),
+]
+
+def haversine_many(lat, lng, lats, lngs):
+    # tw_geo.haversine from one point to arrays of points
+    p1 = np.radians(lat)
+    p2 = np.radians(lats)
+    dl = np.radians(lngs - lng)
+    h = np.sin((p2 - p1) / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(h)))
+
+def smallest(keys, count):
+    # positions of the count smallest rows by keys in np.lexsort order (last
+    # key first), sorted; only rows up to the count-th primary key are sorted
+    primary = keys[-1]
+    if len(primary) > count:
+        bound = np.partition(primary, count - 1)[count - 1]
+        candidates = np.flatnonzero(primary <= bound)
+    else:
+        candidates = np.arange(len(primary))
+    order = np.lexsort(tuple(key[candidates] for key in keys))
+    return candidates[order[:count]]
+
+class EntrySnapshot:
+    # Columnar in-process copy of the unexpired entries that answers the
+    # searches without keywords with NumPy masks. Rows are kept in list column
+    # order for the results; deleted ones are only masked out until the next
+    # load. The database stays the source of truth, tw_db reloads the snapshot
+    # when the day rolls over and after changes it can't follow row by row.
+    # Distances use the haversine formula, so entries within a few meters of
+    # the radius may be decided differently than by PtDistWithin.
+    def __init__(self):
+        self.day = None
+        self.stale = True
+        self._journal = None
+        self._codes = {}
+        self._reset(0)
+
+    def _reset(self, capacity):
+        self._size = 0
+        self._rows = []
+        self._positions = {}
+        self._columns = {name: np.zeros(capacity, dtype) for name, dtype in COLUMNS}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _code(self, value):
+        return self._codes.setdefault(value, len(self._codes))
+
+    def start_load(self):
+        # changes made while the rows are read are replayed by load()
+        self._journal = []
+
+    def abort_load(self):
+        # the rows couldn't be read; searches reload on the next occasion
+        self._journal = None
+        self.stale = True
+
+    def load(self, rows, day):
+        # rows in tw_db.LIST_COLUMNS order, day as an int like 20240131
+        journal = self._journal or []
+        self._journal = None
+        count = len(rows)
+        self._reset(max(2 * count, 1024))
+        if count:
+            ids, users, _, types, kinds, lat, lng, _, inserted, expires = zip(*rows)
+            columns = self._columns
+            columns['ids'][:count] = ids
+            columns['users'][:count] = users
+            columns['lat'][:count] = lat
+            columns['lng'][:count] = lng
+            columns['types'][:count] = [self._code(value) for value in types]
+            columns['kinds'][:count] = [self._code(value) for value in kinds]
+            columns['inserted'][:count] = [int(value) for value in inserted]
+            columns['expires'][:count] = [int(value) for value in expires]
+            columns['alive'][:count] = True
+        self._rows = [tuple(row) for row in rows]
+        self._positions = {row[0]: i for i, row in enumerate(self._rows)}
+        self._size = count
+        self.day = day
+        self.stale = False
+        for change, value in journal:
+            if change == 'add':
+                self.add(value)
+            else:
+                self.remove(value)
+
+    def _grow(self):
+        capacity = max(2 * len(self._columns['ids']), 1024)
+        for name, column in self._columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+
+    def add(self, row):
+        if self._journal is not None:
+            self._journal.append(('add', row))
+        if row[0] in self._positions:
+            return
+        if self._size == len(self._columns['ids']):
+            self._grow()
+        position = self._size
+        columns = self._columns
+        columns['ids'][position] = row[0]
+        columns['users'][position] = row[1]
+        columns['lat'][position] = row[5]
+        columns['lng'][position] = row[6]
+        columns['types'][position] = self._code(row[3])
+        columns['kinds'][position] = self._code(row[4])
+        columns['inserted'][position] = int(row[8])
+        columns['expires'][position] = int(row[9])
+        columns['alive'][position] = True
+        self._rows.append(tuple(row))
+        self._positions[row[0]] = position
+        self._size += 1
+
+    def remove(self, entry_id):
+        if self._journal is not None:
+            self._journal.append(('remove', entry_id))
+        position = self._positions.pop(entry_id, None)
+        if position is not None:
+            self._columns['alive'][position] = False
+            self._rows[position] = None
+
+    def search(self, user_id, type, kind, lat, lng, meters, today):
+        # positions of the matching rows and their distances, None without a
+        # location; same filters as tw_db.entry_filter
+        columns = {name: column[:self._size] for name, column in self._columns.items()}
+        mask = columns['alive'] & (columns['expires'] > today) & (columns['users'] != user_id)
+        for name, value in (('types', type), ('kinds', kind)):
+            if value != 'all':
+                code = self._codes.get(value)
+                if code is None:
+                    return np.zeros(0, np.int64), (None if lat is None else np.zeros(0))
+                mask &= columns[name] == code
+        if lat is None:
+            return np.flatnonzero(mask), None
+        min_lng, min_lat, max_lng, max_lat = bounding_box(lat, lng, meters)
+        mask &= (columns['lat'] >= min_lat) & (columns['lat'] <= max_lat)
+        mask &= (columns['lng'] >= min_lng) & (columns['lng'] <= max_lng)
+        positions = np.flatnonzero(mask)
+        dist = haversine_many(lat, lng, columns['lat'][positions], columns['lng'][positions])
+        within = dist <= meters
+        return positions[within], dist[within]
+
+    def ids(self, user_id, type, kind, lat, lng, meters, today):
+        positions, _ = self.search(user_id, type, kind, lat, lng, meters, today)
+        return self._columns['ids'][positions].tolist()
+
+    def page(self, user_id, type, kind, lat, lng, meters, today, after, limit):
+        # the first limit + 1 rows after the cursor in list columns plus the
+        # distance, ordered and paged like tw_db.entry_page_query
+        positions, dist = self.search(user_id, type, kind, lat, lng, meters, today)
+        ids = self._columns['ids'][positions]
+        if dist is None:
+            # newest first by (inserted_at, id), the cursor holds inserted_at
+            # as the text of the row
+            inserted = self._columns['inserted'][positions]
+            if after is not None:
+                keep = (inserted < int(after[0])) | ((inserted == int(after[0])) & (ids < after[1]))
+                positions, ids, inserted = positions[keep], ids[keep], inserted[keep]
+            top = smallest((-ids, -inserted), limit + 1)
+            return [self._rows[position] + (None,) for position in positions[top]]
+        if after is not None:
+            keep = (dist > after[0]) | ((dist == after[0]) & (ids > after[1]))
+            positions, ids, dist = positions[keep], ids[keep], dist[keep]
+        top = smallest((ids, dist), limit + 1)
+        return [self._rows[position] + (float(distance),) for position, distance in zip(positions[top], dist[top])]
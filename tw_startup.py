@@ -0,0 +1,44 @@
+import sys
+import time
+import subprocess
+from contextlib import contextmanager
+
+# Startup timings for teilwas_bot.py --profile-startup: the init steps record
+# themselves with phase(), imports are measured in a fresh interpreter with
+# python -X importtime.
+phases = []
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - start))
+
+def import_times(module):
+    # seconds spent importing each top-level package (its own modules only,
+    # not its dependencies), slowest first
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{result.stderr[-2000:]}')
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0.0) + int(own) / 1e6
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+def report(module, top=15):
+    imports = import_times(module)
+    print(f'imports of {module}, by package')
+    for package, seconds in imports[:top]:
+        print(f'  {package:<28} {seconds * 1000:8.1f} ms')
+    rest = sum(seconds for _, seconds in imports[top:])
+    print(f'  {f"{len(imports[top:])} more":<28} {rest * 1000:8.1f} ms')
+    print(f'  {"total":<28} {sum(seconds for _, seconds in imports) * 1000:8.1f} ms')
+    print('startup, in order of completion')
+    for name, seconds in phases:
+        print(f'  {name:<28} {seconds * 1000:8.1f} ms')
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import asyncio
+import aiosqlite
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.types.base import TelegramObject
+
+FSM_TTL = int(os.environ.get('TW_FSM_TTL', str(24 * 3600)))
+
+def encode(value):
+    if isinstance(value, TelegramObject):
+        return value.to_python()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def dumps(value):
+    return json.dumps(value, default=encode, separators=(',', ':'))
+
+class SQLiteStorage(BaseStorage):
+    # FSM storage in a table of the bot's SQLite database so that conversations
+    # survive restarts and can be shared by several bot processes. State data
+    # is stored as compact JSON; conversations untouched for longer than ttl
+    # seconds are treated as finished and removed by purge_expired().
+    def __init__(self, path, ttl=FSM_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._db = None
+        self._lock = asyncio.Lock()
+        # all coroutines share one connection, a commit of one would end the
+        # transaction of another
+        self._write_lock = asyncio.Lock()
+
+    async def _connection(self):
+        if self._db is None:
+            async with self._lock:
+                if self._db is None:
+                    db = await aiosqlite.connect(self._path)
+                    await db.execute('PRAGMA journal_mode = WAL;')
+                    await db.execute('PRAGMA synchronous = NORMAL;')
+                    await db.execute('PRAGMA busy_timeout = 5000;')
+                    await db.execute("""CREATE TABLE IF NOT EXISTS fsm_state (
+                        chat TEXT,
+                        user TEXT,
+                        state TEXT,
+                        data TEXT,
+                        bucket TEXT,
+                        updated_at INTEGER,
+                        PRIMARY KEY (chat, user)
+                        ) WITHOUT ROWID;""")
+                    await db.execute("CREATE INDEX IF NOT EXISTS fsm_state_updated_at ON fsm_state(updated_at);")
+                    await db.commit()
+                    self._db = db
+        return self._db
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def wait_closed(self):
+        pass
+
+    def resolve_address(self, chat, user):
+        return tuple(map(str, self.check_address(chat=chat, user=user)))
+
+    async def _get(self, chat, user):
+        db = await self._connection()
+        async with db.execute("SELECT state, data, bucket FROM fsm_state WHERE chat = ? AND user = ? AND updated_at > ?;",
+                (chat, user, int(time.time()) - self._ttl)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None, {}, {}
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    async def _write(self, db, chat, user, fields):
+        # one upsert that replaces the given columns and keeps the others,
+        # unless the conversation expired; an empty conversation is removed
+        now = int(time.time())
+        values = {'state': None, 'data': '{}', 'bucket': '{}'}
+        for name, value in fields.items():
+            values[name] = value if name == 'state' else dumps(value)
+        updates = []
+        params = [chat, user, values['state'], values['data'], values['bucket'], now]
+        for name in values:
+            if name in fields:
+                updates.append(f"{name} = excluded.{name}")
+            else:
+                updates.append(f"{name} = CASE WHEN updated_at > ? THEN {name} ELSE excluded.{name} END")
+                params.append(now - self._ttl)
+        await db.execute(f"""INSERT INTO fsm_state(chat, user, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat, user) DO UPDATE SET {', '.join(updates)}, updated_at = excluded.updated_at;""", params)
+        await db.execute("""DELETE FROM fsm_state WHERE chat = ? AND user = ? AND state IS NULL AND data = '{}' AND bucket = '{}';""",
+            (chat, user))
+
+    async def _set(self, chat, user, **fields):
+        db = await self._connection()
+        async with self._write_lock:
+            await self._write(db, chat, user, fields)
+            await db.commit()
+
+    async def _update(self, chat, user, name, changes):
+        # read-modify-write of data or bucket under the database write lock,
+        # so that other processes can't interleave
+        db = await self._connection()
+        async with self._write_lock:
+            await db.execute("BEGIN IMMEDIATE;")
+            try:
+                _, data, bucket = await self._get(chat, user)
+                current = data if name == 'data' else bucket
+                current.update(changes)
+                await self._write(db, chat, user, {name: current})
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        state, _, _ = await self._get(*self.resolve_address(chat, user))
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, data, _ = await self._get(*self.resolve_address(chat, user))
+        return data
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self._set(*self.resolve_address(chat, user), state=self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self._set(*self.resolve_address(chat, user), data=data or {})
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await self._update(*self.resolve_address(chat, user), 'data', dict(data or {}, **kwargs))
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        if with_data:
+            await self._set(*self.resolve_address(chat, user), state=None, data={})
+        else:
+            await self._set(*self.resolve_address(chat, user), state=None)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, _, bucket = await self._get(*self.resolve_address(chat, user))
+        return bucket
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self._set(*self.resolve_address(chat, user), bucket=bucket or {})
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        await self._update(*self.resolve_address(chat, user), 'bucket', dict(bucket or {}, **kwargs))
+
+    async def count_states(self):
+        # {state: number of live conversations in it}
+        db = await self._connection()
+        async with db.execute("SELECT state, count(*) FROM fsm_state WHERE state IS NOT NULL AND updated_at > ? GROUP BY state;",
+                (int(time.time()) - self._ttl,)) as cursor:
+            return dict(await cursor.fetchall())
+
+    async def purge_expired(self):
+        db = await self._connection()
+        async with self._write_lock:
+            async with db.execute("DELETE FROM fsm_state WHERE updated_at <= ?;", (int(time.time()) - self._ttl,)) as cursor:
+                deleted = cursor.rowcount
+            await db.commit()
+        return deleted
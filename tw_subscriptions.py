@@ -0,0 +1,113 @@
+import os
+import math
+from collections import defaultdict
+
+from tw_geo import bounding_box, haversine
+
+CELL_DEGREES = float(os.environ.get('TW_SUBSCRIPTION_CELL_DEGREES', '0.25'))
+# subscriptions whose radius would spread them over more cells than this are
+# kept in a per-(type, kind) list that is checked linearly instead
+MAX_CELLS = 256
+
+def box_cells(cell, lat, lng, distance):
+    min_lng, min_lat, max_lng, max_lat = bounding_box(lat, lng, distance)
+    if min_lng == -180.0 and max_lng == 180.0:
+        return None
+    lat_range = range(math.floor(min_lat / cell), math.floor(max_lat / cell) + 1)
+    lng_range = range(math.floor(min_lng / cell), math.floor(max_lng / cell) + 1)
+    if len(lat_range) * len(lng_range) > MAX_CELLS:
+        return None
+    return [(y, x) for y in lat_range for x in lng_range]
+
+class SubscriptionIndex:
+    # In-process copy of the subscriptions table for matching new entries
+    # without a database round-trip. Rows are bucketed by (type, kind); within a
+    # bucket "everywhere" subscriptions are listed once and located ones are
+    # registered in every grid cell their radius box touches.
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self._cell = cell_degrees
+        self.clear()
+
+    def clear(self):
+        self._rows = {}
+        self._cells_of = {}
+        self._everywhere = defaultdict(set)
+        self._wide = defaultdict(set)
+        self._grid = defaultdict(lambda: defaultdict(set))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def load(self, rows):
+        self.clear()
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        # row: (id, user_id, user_lang, type, kind, lat, lng, distance, delivery)
+        subscription_id, _, _, type, kind, lat, lng, distance, _ = row
+        if subscription_id in self._rows:
+            self.remove(subscription_id)
+        self._rows[subscription_id] = row
+        bucket = (type, kind)
+        if lat is None:
+            self._everywhere[bucket].add(subscription_id)
+            return
+        cells = box_cells(self._cell, lat, lng, distance)
+        self._cells_of[subscription_id] = cells
+        if cells is None:
+            self._wide[bucket].add(subscription_id)
+            return
+        grid = self._grid[bucket]
+        for c in cells:
+            grid[c].add(subscription_id)
+
+    def remove(self, subscription_id):
+        row = self._rows.pop(subscription_id, None)
+        if row is None:
+            return
+        bucket = (row[3], row[4])
+        cells = self._cells_of.pop(subscription_id, None)
+        if row[5] is None:
+            self._everywhere[bucket].discard(subscription_id)
+        elif cells is None:
+            self._wide[bucket].discard(subscription_id)
+        else:
+            grid = self._grid[bucket]
+            for c in cells:
+                members = grid.get(c)
+                if members is not None:
+                    members.discard(subscription_id)
+                    if not members:
+                        del grid[c]
+
+    def match(self, user_id, type, kind, lat, lng):
+        # same result set as tw_db.SUBSCRIPTION_SEARCH_QUERY; distances use the
+        # haversine formula, so points within a few meters of a subscription's
+        # radius may be decided differently than by PtDistWithin
+        cell = (math.floor(lat / self._cell), math.floor(lng / self._cell))
+        res = []
+        for bucket in {(type, kind), (type, 'all'), ('all', kind), ('all', 'all')}:
+            candidates = list(self._everywhere.get(bucket, ()))
+            located = list(self._wide.get(bucket, ()))
+            grid = self._grid.get(bucket)
+            if grid is not None:
+                located += grid.get(cell, ())
+            for subscription_id in located:
+                row = self._rows[subscription_id]
+                if haversine(row[5], row[6], lat, lng) <= row[7]:
+                    candidates.append(subscription_id)
+            for subscription_id in candidates:
+                row = self._rows[subscription_id]
+                if row[1] != user_id:
+                    res.append((row[1], row[2], row[7], row[8]))
+        return res
+
+    def diff(self, rows):
+        # compares the index against a fresh copy of the table and returns the
+        # ids that are missing, stale or unknown
+        expected = {row[0]: tuple(row) for row in rows}
+        missing = [i for i in expected if i not in self._rows]
+        stale = [i for i in expected if i in self._rows and tuple(self._rows[i]) != expected[i]]
+        unknown = [i for i in self._rows if i not in expected]
+        return missing, stale, unknown
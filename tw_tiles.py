@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+import tempfile
+import requests
+import staticmaps
+from collections import OrderedDict
+from email.utils import formatdate
+
+TILE_CACHE_DIR = os.environ.get('TW_TILE_CACHE_DIR', 'tile_cache')
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TW_TILE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+TILE_CACHE_TTL = int(os.environ.get('TW_TILE_CACHE_TTL', str(7 * 24 * 3600)))
+TILE_MEMORY_TILES = int(os.environ.get('TW_TILE_MEMORY_TILES', '256'))
+TILE_USER_AGENT = os.environ.get('TW_TILE_USER_AGENT')
+
+class CachingTileDownloader(staticmaps.TileDownloader):
+    # Tiles are looked up in a small in-memory LRU first, then on disk under
+    # <cache dir>/<provider>/<z>/<x>/<y>.png. The disk store is capped at
+    # max_bytes and evicts least recently used tiles; tiles older than ttl are
+    # revalidated with a conditional request and served stale if that fails.
+    # A tile's mtime is when it was fetched, its atime when it was last used;
+    # hits set the atime, so the LRU order survives a rescan or restart.
+    # The render pool processes share the directory: each one tracks its own
+    # writes and rescans the directory after every tenth of max_bytes written
+    # and before evicting, so together they overshoot the cap by at most a
+    # tenth of it per process.
+    def __init__(self, cache_dir=TILE_CACHE_DIR, max_bytes=TILE_CACHE_MAX_BYTES, ttl=TILE_CACHE_TTL, memory_tiles=TILE_MEMORY_TILES):
+        staticmaps.TileDownloader.__init__(self)
+        if TILE_USER_AGENT:
+            self.set_user_agent(TILE_USER_AGENT)
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._memory_tiles = memory_tiles
+        self._lock = threading.Lock()
+        self._timings = threading.local()
+        self._session = requests.Session()
+        self._memory = OrderedDict()
+        self._scan()
+
+    def _scan(self):
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._written = 0
+        files = []
+        for root, _, names in os.walk(self._cache_dir):
+            for name in names:
+                if name.endswith('.tmp'):
+                    # being written by some process
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_atime, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._disk[path] = size
+            self._disk_bytes += size
+
+    def start_timing(self):
+        # from now on get() records (source, seconds) of every tile requested
+        # by the calling thread until take_timings()
+        self._timings.tiles = []
+
+    def take_timings(self):
+        tiles = getattr(self._timings, 'tiles', None)
+        self._timings.tiles = None
+        return tiles or []
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        start = time.perf_counter()
+        data, source = self._get(provider, zoom, x, y)
+        tiles = getattr(self._timings, 'tiles', None)
+        if tiles is not None and source is not None:
+            tiles.append((source, time.perf_counter() - start))
+        return data
+
+    def _get(self, provider, zoom, x, y):
+        url = provider.url(zoom, x, y)
+        if url is None:
+            return None, None
+        path = self.cache_file_name(provider, self._cache_dir, zoom, x, y)
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(path)
+            hit = cached is not None and now - cached[1] < self._ttl
+            if hit:
+                self._memory.move_to_end(path)
+                if path in self._disk:
+                    self._disk.move_to_end(path)
+        if hit:
+            self._touch(path, now, cached[1])
+            return cached[0], 'memory'
+
+        data, fetched_at = self._read(path)
+        if data is not None and now - fetched_at < self._ttl:
+            self._touch(path, now, fetched_at)
+            self._remember(path, data, fetched_at)
+            return data, 'disk'
+
+        try:
+            fresh = self._fetch(url, fetched_at if data is not None else None)
+        except (requests.RequestException, RuntimeError):
+            if data is None:
+                raise
+            return data, 'stale'
+        if fresh is None:
+            # 304: the stale copy is still current
+            try:
+                os.utime(path)
+            except OSError:
+                # evicted by another render process meanwhile
+                self._write(path, data)
+            self._remember(path, data, now)
+            return data, 'not_modified'
+        self._write(path, fresh)
+        self._remember(path, fresh, now)
+        return fresh, 'fetch'
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(), os.fstat(f.fileno()).st_mtime
+        except OSError:
+            return None, None
+
+    def _touch(self, path, used_at, fetched_at):
+        try:
+            os.utime(path, (used_at, fetched_at))
+        except OSError:
+            # evicted by another render process
+            pass
+
+    def _fetch(self, url, modified_since):
+        headers = {'user-agent': self._user_agent}
+        if modified_since is not None:
+            headers['if-modified-since'] = formatdate(modified_since, usegmt=True)
+        res = self._session.get(url, headers=headers, timeout=10)
+        if res.status_code == 304:
+            return None
+        if res.status_code != 200:
+            raise RuntimeError(f'fetch {url} yields {res.status_code}')
+        return res.content
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _remember(self, path, data, fetched_at):
+        with self._lock:
+            self._memory[path] = (data, fetched_at)
+            self._memory.move_to_end(path)
+            while len(self._memory) > self._memory_tiles:
+                self._memory.popitem(last=False)
+            added = len(data) - self._disk.pop(path, 0)
+            self._disk_bytes += added
+            self._written += added
+            self._disk[path] = len(data)
+            evicted = []
+            if self._disk_bytes > self._max_bytes or self._written > self._max_bytes // 10:
+                # count what the other processes wrote
+                self._scan()
+            if self._disk_bytes > self._max_bytes:
+                # down to 90% so that the next eviction is a while away
+                while self._disk_bytes > self._max_bytes * 0.9 and len(self._disk) > 1:
+                    old_path, size = self._disk.popitem(last=False)
+                    self._disk_bytes -= size
+                    self._memory.pop(old_path, None)
+                    evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
@@ -0,0 +1,140 @@
+# Webhook mode: an aiohttp front end receives updates from Telegram and shards
+# them by chat id onto worker processes, each running the full bot with its own
+# event loop. All updates of one chat go to the same worker and are processed
+# there one after another, so per-user ordering is preserved. The front end
+# migrates the database before it starts the workers. GET /ready answers 200
+# once all workers are up.
+#
+#   python tw_webhook.py
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WEBHOOK_HOST = os.environ.get('TW_WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('TW_WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.environ.get('TW_WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.environ.get('TW_WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('TW_WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.environ.get('TW_WEBHOOK_WORKERS', str(os.cpu_count() or 1)))
+
+def update_chat_id(update):
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    query = update.get('callback_query')
+    if query is not None:
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+def run_worker(index, queue, ready):
+    # the front end decides when to stop, Ctrl-C only reaches it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ['TW_WORKER_INDEX'] = str(index)
+    asyncio.run(serve_worker(queue, ready))
+
+async def process_after(previous, dp, update):
+    from aiogram import types
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dp.process_update(types.Update(**update))
+    except Exception:
+        logging.exception('Failed to process update %s', update.get('update_id'))
+
+async def serve_worker(queue, ready):
+    from aiogram import Bot, Dispatcher
+    from teilwas_bot import dp, on_startup, on_shutdown
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    ready.set()
+    loop = asyncio.get_running_loop()
+    # the last scheduled update of every chat that is still running; the next
+    # update of that chat waits for it
+    chats = {}
+    def done(chat_id, task):
+        if chats.get(chat_id) is task:
+            del chats[chat_id]
+    while True:
+        item = await loop.run_in_executor(None, queue.get)
+        if item is None:
+            break
+        chat_id, update = item
+        task = asyncio.create_task(process_after(chats.get(chat_id), dp, update))
+        chats[chat_id] = task
+        task.add_done_callback(lambda t, c=chat_id: done(c, t))
+    # drain what was already accepted before shutting down
+    await asyncio.gather(*chats.values(), return_exceptions=True)
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    session = await dp.bot.get_session()
+    await session.close()
+
+async def handle_update(request):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    update = await request.json()
+    queues = request.app['queues']
+    chat_id = update_chat_id(update)
+    queues[chat_id % len(queues)].put((chat_id, update))
+    return web.Response()
+
+async def handle_ready(request):
+    # ready once every worker finished on_startup; updates arriving earlier
+    # wait in the queues
+    if all(event.is_set() for event in request.app['ready']):
+        return web.Response(text='ready\n')
+    return web.Response(status=503, text='starting\n')
+
+async def start_workers(app):
+    # the migrations run once here; the workers only open their pools
+    from tw_db import migrate_db, close_db
+    await migrate_db()
+    await close_db()
+    ctx = multiprocessing.get_context('spawn')
+    app['queues'] = [ctx.Queue() for _ in range(WEBHOOK_WORKERS)]
+    app['ready'] = [ctx.Event() for _ in range(WEBHOOK_WORKERS)]
+    app['workers'] = [ctx.Process(target=run_worker, args=(i, q, e), name=f'tw_worker_{i}')
+        for i, (q, e) in enumerate(zip(app['queues'], app['ready']))]
+    for process in app['workers']:
+        process.start()
+    if WEBHOOK_URL:
+        from aiogram import Bot
+        from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+        api_url = os.environ.get('TW_TELEGRAM_API_URL')
+        bot = Bot(token=os.environ.get('TELEGRAM_API_TOKEN'), server=TelegramAPIServer.from_base(api_url) if api_url else TELEGRAM_PRODUCTION)
+        # keep the updates that queued up while the bot was down
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+        await (await bot.get_session()).close()
+
+async def stop_workers(app):
+    # run after the server stopped accepting requests
+    for queue in app['queues']:
+        queue.put(None)
+    loop = asyncio.get_running_loop()
+    for process in app['workers']:
+        await loop.run_in_executor(None, process.join)
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get('/ready', handle_ready)
+    app.on_startup.append(start_workers)
+    app.on_cleanup.append(stop_workers)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, access_log=None)
+
+if __name__ == '__main__':
+    main()